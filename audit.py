@@ -0,0 +1,102 @@
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import List, Dict, Optional
+
+import psycopg2
+from psycopg2.extras import Json, execute_values
+
+
+# Асинхронный журнал изменений: события копятся в ограниченной очереди
+# и пишутся в таблицу audit_log пачками из фонового потока
+class AuditLog:
+    def __init__(self, dsn: str, max_queue: int = 10000, batch_size: int = 200,
+                 flush_interval: float = 2.0):
+        self.dsn = dsn
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.connection = None
+        # Пачка, которую не удалось записать, повторяется при следующей попытке
+        self._pending: List[tuple] = []
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def record(self, chat_id: Optional[int], action: str, entity: str, entity_id: Optional[int],
+               before: Optional[Dict] = None, after: Optional[Dict] = None):
+        event = (chat_id, action, entity, entity_id, before, after, datetime.now().astimezone())
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            print(f"⚠️ Очередь аудита переполнена, событие отброшено ({self.dropped} всего)")
+
+    def flush(self):
+        # Синхронно записывает все накопленные события (для /audit и остановки)
+        with self._write_lock:
+            batch = self._pending + self._drain(self.max_queue)
+            self._pending = []
+            if batch:
+                self._write(batch)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                first = None
+            with self._write_lock:
+                batch = self._pending + ([first] if first else []) + self._drain(self.batch_size)
+                self._pending = []
+                failed = bool(batch) and not self._write(batch)
+            if failed:
+                time.sleep(self.flush_interval)
+
+    def _drain(self, limit: int) -> List[tuple]:
+        events = []
+        while len(events) < limit:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def _write(self, batch: List[tuple]) -> bool:
+        rows = [
+            (chat_id, action, entity, entity_id,
+             Json(before) if before is not None else None,
+             Json(after) if after is not None else None,
+             created_at)
+            for chat_id, action, entity, entity_id, before, after, created_at in batch
+        ]
+        try:
+            if self.connection is None or self.connection.closed:
+                self.connection = psycopg2.connect(self.dsn)
+            with self.connection.cursor() as cursor:
+                execute_values(cursor, """
+                INSERT INTO audit_log (chat_id, action, entity, entity_id, before_data, after_data, created_at)
+                VALUES %s
+                """, rows, page_size=self.batch_size)
+            self.connection.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Ошибка записи журнала аудита: {e}")
+            try:
+                self.connection.rollback()
+            except Exception:
+                self.connection = None
+            self._pending = batch[-self.max_queue:]
+            return False
@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+from typing import List, Dict, Optional
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from metrics import Counter, Gauge
+
+WRITE_BATCHES = Counter("college_bot_write_batches_total", "Транзакции группового коммита")
+WRITE_BATCHED = Counter("college_bot_write_batched_total",
+                        "Записи, прошедшие через групповой коммит: ok, error или timeout")
+WRITE_BATCH_SIZE = Gauge("college_bot_write_batch_size", "Размер последней пачки записей")
+
+
+# Состояния записи: ждет в очереди, выполняется, выполнена и ждет COMMIT пачки, отменена по таймауту
+QUEUED, RUNNING, KEPT, CANCELLED = "queued", "running", "kept", "cancelled"
+
+
+class PendingWrite:
+    __slots__ = ('query', 'params', 'deadline_at', 'state', 'done', 'rows', 'error')
+
+    def __init__(self, query: str, params: tuple, deadline_at: Optional[float]):
+        self.query = query
+        self.params = params
+        self.deadline_at = deadline_at
+        self.state = QUEUED
+        self.done = threading.Event()
+        self.rows: List[Dict] = []
+        self.error: Optional[Exception] = None
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline_at is None else self.deadline_at - time.monotonic()
+
+
+# Групповой коммит: записи из разных чатов, пришедшие в течение window_ms, выполняются
+# в одной транзакции (один COMMIT и один fsync на всю пачку). Каждая запись идет после
+# своего SAVEPOINT, поэтому ошибка одной откатывает только ее, и вызывающий получает свой результат.
+# У каждой записи свой statement_timeout - оставшееся время вызывающего: запись, ждущая блокировку,
+# задерживает пачку не дольше этого времени, а записи, чьи вызывающие уже не ждут, пропускаются
+class WriteBatcher:
+    def __init__(self, node, window_ms: float = 5.0, max_batch: int = 64, timeout_ms: int = None):
+        self.node = node
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout_ms = timeout_ms
+        self.writes: "queue.Queue[PendingWrite]" = queue.Queue()
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="write-batcher", daemon=True)
+        self._thread.start()
+
+    # Блокирует до коммита пачки; ошибки этой записи или всей транзакции пробрасываются вызывающему.
+    # timeout_ms - сколько осталось у вызывающего; не дождались - TimeoutError, запись не применяется
+    def submit(self, query: str, params: tuple = None, timeout_ms: int = None) -> List[Dict]:
+        timeout_ms = timeout_ms or self.timeout_ms
+        write = PendingWrite(query, params or (), time.monotonic() + timeout_ms / 1000 if timeout_ms else None)
+        self.writes.put(write)
+        if not write.done.wait(write.remaining()):
+            with self.lock:
+                if write.state != KEPT:
+                    write.state = CANCELLED
+            if write.state == CANCELLED:
+                raise TimeoutError("Запись не выполнена за отведенное время")
+            # Запись уже выполнена и ждет COMMIT пачки - отменить ее нельзя, ждем результат
+            write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.rows
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        # После stop дописываем то, что уже в очереди: вызывающие ждут результата
+        while not self._stop.is_set() or not self.writes.empty():
+            try:
+                batch = [self.writes.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.writes.get(timeout=remaining) if remaining > 0 else self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch: List[PendingWrite]):
+        WRITE_BATCHES.inc()
+        WRITE_BATCH_SIZE.set(len(batch))
+        try:
+            with self.node.connection() as conn:
+                try:
+                    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                        for write in batch:
+                            self._execute(cursor, write)
+                    conn.commit()
+                except Exception:
+                    if not conn.closed:
+                        conn.rollback()
+                    raise
+        except Exception as e:
+            # Транзакция не закоммичена - не прошла ни одна запись пачки
+            for write in batch:
+                write.rows, write.error = [], e
+        for write in batch:
+            WRITE_BATCHED.inc(result="timeout" if write.state == CANCELLED else "error" if write.error else "ok")
+            write.done.set()
+
+    def _execute(self, cursor, write: PendingWrite):
+        with self.lock:
+            remaining = write.remaining()
+            if write.state == CANCELLED or (remaining is not None and remaining <= 0):
+                write.state = CANCELLED
+                write.error = TimeoutError("Запись не выполнена за отведенное время")
+                return
+            write.state = RUNNING
+        # SAVEPOINT и таймаут этой записи уходят тем же запросом, что и сама запись;
+        # SET LOCAL после SAVEPOINT откатывается вместе с записью
+        timeout = "DEFAULT" if remaining is None else max(1, int(remaining * 1000))
+        try:
+            cursor.execute(f"SAVEPOINT batch_write; SET LOCAL statement_timeout = {timeout}; {write.query}",
+                           write.params)
+            rows = cursor.fetchall() if cursor.description else []
+        except psycopg2.Error as e:
+            # Обрыв соединения касается всей пачки. Ошибка сервера на живом соединении - таймаут,
+            # взаимоблокировка, конфликт сериализации, нарушение ограничения - только этой записи
+            if isinstance(e, psycopg2.InterfaceError) or cursor.connection.closed:
+                raise
+            cursor.execute("ROLLBACK TO SAVEPOINT batch_write; RELEASE SAVEPOINT batch_write")
+            write.error = e
+            return
+        with self.lock:
+            # Вызывающий перестал ждать, пока запись выполнялась, - откатываем только ее
+            cancelled = write.state == CANCELLED
+            if not cancelled:
+                write.state = KEPT
+        if cancelled:
+            cursor.execute("ROLLBACK TO SAVEPOINT batch_write; RELEASE SAVEPOINT batch_write")
+            write.error = TimeoutError("Запись не выполнена за отведенное время")
+        else:
+            cursor.execute("RELEASE SAVEPOINT batch_write")
+            write.rows = rows
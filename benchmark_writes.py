@@ -0,0 +1,97 @@
+import argparse
+import statistics
+import threading
+import time
+from typing import Callable, List
+
+from batching import WriteBatcher
+from database import DatabaseNode, DB_PRIMARY_DSN, DB_POOL_SIZE
+
+# Сравнение группового коммита с отдельной транзакцией на каждую запись.
+# Запуск: python benchmark_writes.py --threads 32 --writes 50 --windows 1,2,5,10
+# Пишет во временную таблицу write_benchmark, которая удаляется в конце
+
+INSERT = "INSERT INTO write_benchmark (chat_id, value) VALUES (%s, %s) RETURNING id"
+
+
+def per_write_commit(node: DatabaseNode) -> Callable:
+    # Как и в боте, одновременных транзакций не больше, чем соединений в пуле
+    slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+    def write(chat_id: int, value: int):
+        with slots, node.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(INSERT, (chat_id, value))
+                cursor.fetchall()
+            conn.commit()
+    return write
+
+
+def run(name: str, write: Callable, threads: int, writes: int):
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def chat(chat_id: int):
+        local = []
+        for value in range(writes):
+            started = time.perf_counter()
+            write(chat_id, value)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=chat, args=(chat_id,)) for chat_id in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<22} {len(latencies) / elapsed:10.0f} зап/с   "
+          f"p50 {statistics.median(latencies) * 1000:7.2f} мс   p99 {p99 * 1000:7.2f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Групповой коммит против коммита на каждую запись")
+    parser.add_argument("--threads", type=int, default=32, help="одновременных чатов")
+    parser.add_argument("--writes", type=int, default=50, help="записей на чат")
+    parser.add_argument("--windows", default="1,2,5,10", help="окна группового коммита, мс")
+    parser.add_argument("--max-batch", type=int, default=64)
+    args = parser.parse_args()
+
+    node = DatabaseNode("primary", DB_PRIMARY_DSN)
+    if not node.open():
+        return
+    with node.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS write_benchmark (
+                id SERIAL PRIMARY KEY,
+                chat_id BIGINT,
+                value INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+        conn.commit()
+
+    try:
+        print(f"{args.threads} чатов x {args.writes} записей")
+        run("коммит на запись", per_write_commit(node), args.threads, args.writes)
+        for window_ms in (float(w) for w in args.windows.split(",")):
+            batcher = WriteBatcher(node, window_ms, args.max_batch)
+            run(f"окно {window_ms:g} мс", lambda chat_id, value: batcher.submit(INSERT, (chat_id, value)),
+                args.threads, args.writes)
+            batcher.close()
+    finally:
+        with node.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS write_benchmark")
+            conn.commit()
+        node.close()
+
+
+if __name__ == "__main__":
+    main()
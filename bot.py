@@ -1,237 +1,154 @@
 import telebot
-from telebot.types import ReplyKeyboardMarkup, KeyboardButton
+from telebot.types import ReplyKeyboardMarkup, KeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 import logging
-import psycopg2
-from psycopg2.extras import RealDictCursor
 from typing import List, Dict, Any
 import requests
 import time
 import os
+import io
+import re
+import signal
 from dotenv import load_dotenv
+from audit import AuditLog
+from notifications import GradeNotifier
+from updates import UpdateCheckpoint, UpdatePoller
+from metrics import start_metrics_server
+from profiling import Profiler
+from search import NameIndex
+from ratelimit import RateLimiter, ReplyCache, RATE_LIMIT_SHED_REPLIES
+from database import CollegeDatabase, DatabaseUnavailable, current_academic_year, DB_PRIMARY_DSN, DB_REPLICA_DSNS, DB_HANDLER_DEADLINE, DB_POOL_SIZE
 
 # Загружаем переменные из .env файла
 load_dotenv()
 
-# Настройки базы данных из .env
-DB_CONFIG = {
-    "host": os.getenv("DB_HOST", "localhost"),
-    "database": os.getenv("DB_NAME", "college_db"),
-    "user": os.getenv("DB_USER", "postgres"), 
-    "password": os.getenv("DB_PASSWORD", "2008"),
-    "port": os.getenv("DB_PORT", "5432")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Файл с позицией обработанных обновлений Telegram и число потоков-обработчиков
+UPDATE_STATE_FILE = os.getenv("UPDATE_STATE_FILE", "update_offset.json")
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "4"))
+
+# Лимит входящих сообщений (токенов в секунду и запас) на чат и на весь бот
+RATE_LIMIT_CHAT_RATE = float(os.getenv("RATE_LIMIT_CHAT_RATE", "1"))
+RATE_LIMIT_CHAT_BURST = float(os.getenv("RATE_LIMIT_CHAT_BURST", "10"))
+RATE_LIMIT_GLOBAL_RATE = float(os.getenv("RATE_LIMIT_GLOBAL_RATE", "50"))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "200"))
+# Стоимость маршрутов в токенах: статистика и списки читают целые таблицы
+RATE_LIMIT_COSTS = {
+    "stats": float(os.getenv("RATE_LIMIT_COST_STATS", "5")),
+    "listing": float(os.getenv("RATE_LIMIT_COST_LISTING", "3")),
+    "lookup": 1.0,
 }
+ROUTES = {
+    "📊 Статистика": "stats",
+    "🎓 Все студенты": "listing",
+    "👨‍🏫 Все преподаватели": "listing",
+    "📚 Все оценки": "listing",
+}
+
+# Чаты администраторов (через запятую): им доступны команды /audit и /profile
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv("ADMIN_CHAT_IDS", "").split(",") if chat_id.strip()}
+PROFILE_MAX_SECONDS = 120
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "8443013412:AAEBU9thmjqggPGPKCO9z13dNYA_l_Myx2M")
 
-class CollegeDatabase:
-    def __init__(self):
-        self.connection = None
-        self.connect()
-    
-    def connect(self):
-        try:
-            self.connection = psycopg2.connect(**DB_CONFIG)
-            print("✅ Connected to PostgreSQL database")
-        except Exception as e:
-            print(f"❌ Database connection failed: {e}")
-    
-    def execute_query(self, query: str, params: tuple = None) -> List[Dict]:
-        try:
-            with self.connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params or ())
-                if query.strip().upper().startswith('SELECT'):
-                    return cursor.fetchall()
-                self.connection.commit()
-                return []
-        except Exception as e:
-            print(f"❌ Query execution error: {e}")
-            self.connection.rollback()
-            return []
-    
-    # GET методы
-    def get_all_students(self) -> List[Dict]:
-        query = """
-        SELECT s.*, g.name as group_name 
-        FROM students s 
-        LEFT JOIN groups g ON s.group_id = g.id
-        ORDER BY s.id
-        """
-        return self.execute_query(query)
-    
-    def get_all_teachers(self) -> List[Dict]:
-        query = """
-        SELECT t.*, d.name as department_name 
-        FROM teachers t 
-        LEFT JOIN departments d ON t.department_id = d.id
-        ORDER BY t.id
-        """
-        return self.execute_query(query)
-    
-    def get_all_groups(self) -> List[Dict]:
-        query = "SELECT * FROM groups ORDER BY id"
-        return self.execute_query(query)
-    
-    def get_all_departments(self) -> List[Dict]:
-        query = "SELECT * FROM departments ORDER BY id"
-        return self.execute_query(query)
-    
-    def get_all_subjects(self) -> List[Dict]:
-        query = "SELECT * FROM subjects ORDER BY id"
-        return self.execute_query(query)
-    
-    def get_all_grades(self) -> List[Dict]:
-        query = """
-        SELECT g.*, s.first_name as student_first_name, s.last_name as student_last_name,
-               sub.name as subject_name, t.first_name as teacher_first_name, t.last_name as teacher_last_name
-        FROM grades g
-        JOIN students s ON g.student_id = s.id
-        JOIN subjects sub ON g.subject_id = sub.id
-        JOIN teachers t ON g.teacher_id = t.id
-        ORDER BY g.id
-        """
-        return self.execute_query(query)
-    
-    def get_student_by_id(self, student_id: int) -> Dict:
-        query = """
-        SELECT s.*, g.name as group_name 
-        FROM students s 
-        LEFT JOIN groups g ON s.group_id = g.id 
-        WHERE s.id = %s
-        """
-        result = self.execute_query(query, (student_id,))
-        return result[0] if result else {}
-    
-    def get_teacher_by_id(self, teacher_id: int) -> Dict:
-        query = """
-        SELECT t.*, d.name as department_name 
-        FROM teachers t 
-        LEFT JOIN departments d ON t.department_id = d.id 
-        WHERE t.id = %s
-        """
-        result = self.execute_query(query, (teacher_id,))
-        return result[0] if result else {}
-
-    def get_grade_by_id(self, grade_id: int) -> Dict:
-        query = """
-        SELECT g.*, s.first_name as student_first_name, s.last_name as student_last_name,
-               sub.name as subject_name, t.first_name as teacher_first_name, t.last_name as teacher_last_name
-        FROM grades g
-        JOIN students s ON g.student_id = s.id
-        JOIN subjects sub ON g.subject_id = sub.id
-        JOIN teachers t ON g.teacher_id = t.id
-        WHERE g.id = %s
-        """
-        result = self.execute_query(query, (grade_id,))
-        return result[0] if result else {}
-
-    # ADD методы
-    def add_student(self, first_name: str, last_name: str, email: str, phone: str, group_id: int) -> bool:
-        query = """
-        INSERT INTO students (first_name, last_name, email, phone, group_id, enrollment_date)
-        VALUES (%s, %s, %s, %s, %s, CURRENT_DATE)
-        """
-        try:
-            self.execute_query(query, (first_name, last_name, email, phone, group_id))
-            return True
-        except Exception as e:
-            print(f"❌ Error adding student: {e}")
-            return False
-    
-    def add_teacher(self, first_name: str, last_name: str, email: str, phone: str, department_id: int) -> bool:
-        query = """
-        INSERT INTO teachers (first_name, last_name, email, phone, department_id, hire_date)
-        VALUES (%s, %s, %s, %s, %s, CURRENT_DATE)
-        """
-        try:
-            self.execute_query(query, (first_name, last_name, email, phone, department_id))
-            return True
-        except Exception as e:
-            print(f"❌ Error adding teacher: {e}")
-            return False
-    
-    def add_grade(self, student_id: int, subject_id: int, grade: int, teacher_id: int) -> bool:
-        query = """
-        INSERT INTO grades (student_id, subject_id, grade, teacher_id, exam_date)
-        VALUES (%s, %s, %s, %s, CURRENT_DATE)
-        """
-        try:
-            self.execute_query(query, (student_id, subject_id, grade, teacher_id))
-            return True
-        except Exception as e:
-            print(f"❌ Error adding grade: {e}")
-            return False
+# Отбрасывает сообщения сверх лимита до обработчиков и БД. Вместо ответа -
+# последний готовый результат этой кнопки или короткое предупреждение (не чаще раза в notice_interval)
+class RateLimitMiddleware(BaseMiddleware):
+    def __init__(self, bot: telebot.TeleBot, limiter: RateLimiter, reply_cache: ReplyCache,
+                 notice_interval: float = 10.0):
+        super().__init__()
+        self.update_types = ['message']
+        self.bot = bot
+        self.limiter = limiter
+        self.reply_cache = reply_cache
+        self.notice_interval = notice_interval
 
-    # UPDATE методы
-    def update_student(self, student_id: int, first_name: str, last_name: str, email: str, phone: str, group_id: int) -> bool:
-        query = """
-        UPDATE students 
-        SET first_name = %s, last_name = %s, email = %s, phone = %s, group_id = %s
-        WHERE id = %s
-        """
-        try:
-            self.execute_query(query, (first_name, last_name, email, phone, group_id, student_id))
-            return True
-        except Exception as e:
-            print(f"❌ Error updating student: {e}")
-            return False
-    
-    def update_teacher(self, teacher_id: int, first_name: str, last_name: str, email: str, phone: str, department_id: int) -> bool:
-        query = """
-        UPDATE teachers 
-        SET first_name = %s, last_name = %s, email = %s, phone = %s, department_id = %s
-        WHERE id = %s
-        """
-        try:
-            self.execute_query(query, (first_name, last_name, email, phone, department_id, teacher_id))
-            return True
-        except Exception as e:
-            print(f"❌ Error updating teacher: {e}")
-            return False
-    
-    def update_grade(self, grade_id: int, grade: int) -> bool:
-        query = """
-        UPDATE grades 
-        SET grade = %s
-        WHERE id = %s
-        """
-        try:
-            self.execute_query(query, (grade, grade_id))
-            return True
-        except Exception as e:
-            print(f"❌ Error updating grade: {e}")
-            return False
+    def pre_process(self, message, data):
+        route = ROUTES.get(message.text, "lookup")
+        reason, wait = self.limiter.acquire(message.chat.id, route)
+        if reason is None:
+            return None
 
-    # DELETE методы
-    def delete_student(self, student_id: int) -> bool:
-        query = "DELETE FROM students WHERE id = %s"
-        try:
-            self.execute_query(query, (student_id,))
-            return True
-        except Exception as e:
-            print(f"❌ Error deleting student: {e}")
-            return False
-    
-    def delete_teacher(self, teacher_id: int) -> bool:
-        query = "DELETE FROM teachers WHERE id = %s"
-        try:
-            self.execute_query(query, (teacher_id,))
-            return True
-        except Exception as e:
-            print(f"❌ Error deleting teacher: {e}")
-            return False
-    
-    def delete_grade(self, grade_id: int) -> bool:
-        query = "DELETE FROM grades WHERE id = %s"
+        if not self.limiter.claim_notice(message.chat.id, self.notice_interval):
+            return CancelUpdate()
+
+        cached = self.reply_cache.get(message.text) if route != "lookup" else None
         try:
-            self.execute_query(query, (grade_id,))
-            return True
+            if cached:
+                cached_at, text = cached
+                self.bot.send_message(
+                    message.chat.id,
+                    f"⏳ Слишком много запросов, данные на {time.strftime('%H:%M:%S', time.localtime(cached_at))}\n\n{text}"
+                )
+                RATE_LIMIT_SHED_REPLIES.inc(kind="cached")
+            else:
+                self.bot.send_message(message.chat.id,
+                                      f"⏳ Слишком много запросов, повторите через {max(1, round(wait))} сек")
+                RATE_LIMIT_SHED_REPLIES.inc(kind="notice")
         except Exception as e:
-            print(f"❌ Error deleting grade: {e}")
-            return False
+            print(f"⚠️ Не удалось ответить на отброшенное сообщение: {e}")
+        return CancelUpdate()
+
+    def post_process(self, message, data, exception):
+        pass
+
+# Контекст запроса для БД: чат текущего сообщения (read-your-writes)
+# и общий дедлайн на все запросы обработчика
+class ChatContextMiddleware(BaseMiddleware):
+    def __init__(self, database: CollegeDatabase):
+        super().__init__()
+        self.update_types = ['message']
+        self.database = database
+
+    def pre_process(self, message, data):
+        self.database.set_chat(message.chat.id)
+        self.database.set_deadline(time.monotonic() + DB_HANDLER_DEADLINE)
+
+    def post_process(self, message, data, exception):
+        self.database.set_chat(None)
+        self.database.set_deadline(None)
+
+# Сообщает пользователю о недоступной БД, если обработчик сам не обработал ошибку
+class DatabaseErrorMiddleware(BaseMiddleware):
+    def __init__(self, bot: telebot.TeleBot):
+        super().__init__()
+        self.update_types = ['message']
+        self.bot = bot
+
+    def pre_process(self, message, data):
+        pass
+
+    def post_process(self, message, data, exception):
+        if isinstance(exception, DatabaseUnavailable):
+            self.bot.send_message(message.chat.id, f"⏳ {exception}")
 
 # Инициализация бота и базы данных
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
-db = CollegeDatabase()
+# Обработчики запускает UpdatePoller в своем пуле, чтобы знать, когда обновление обработано
+bot = telebot.TeleBot(TELEGRAM_TOKEN, threaded=False, use_class_middlewares=True)
+audit_log = AuditLog(DB_PRIMARY_DSN)
+db = CollegeDatabase(DB_PRIMARY_DSN, DB_REPLICA_DSNS, audit_log)
+# Соединения основного сервера нужны обработчикам и фоновым потокам: проверке серверов,
+# уведомлениям об оценках, индексу имен и групповому коммиту
+DB_THREADS = BOT_WORKERS + 3 + (1 if db.batcher else 0)
+if DB_POOL_SIZE < DB_THREADS:
+    print(f"⚠️ DB_POOL_SIZE={DB_POOL_SIZE} меньше числа потоков, работающих с БД ({DB_THREADS}): "
+          f"запросы будут ждать свободного соединения")
+reply_cache = ReplyCache()
+# Лимит идет первым: отброшенное сообщение не доходит до остальных middleware
+bot.setup_middleware(RateLimitMiddleware(bot, RateLimiter(
+    RATE_LIMIT_CHAT_RATE, RATE_LIMIT_CHAT_BURST, RATE_LIMIT_GLOBAL_RATE, RATE_LIMIT_GLOBAL_BURST, RATE_LIMIT_COSTS
+), reply_cache))
+bot.setup_middleware(ChatContextMiddleware(db))
+bot.setup_middleware(DatabaseErrorMiddleware(bot))
+notifier = GradeNotifier(bot, db)
+profiler = Profiler(__file__)
+name_index = NameIndex(db)
+db.write_listeners.append(name_index.on_write)
+db.write_listeners.append(notifier.on_write)
+if db.changes:
+    db.changes.callbacks.append(notifier.on_change)
+    db.changes.callbacks.append(name_index.on_change)
 
 # Состояния для многошаговых операций
 user_states = {}
@@ -263,6 +180,159 @@ def start_message(message):
         reply_markup=create_main_keyboard()
     )
 
+# ЖУРНАЛ ИЗМЕНЕНИЙ
+AUDIT_ENTITIES = {
+    "student": "student", "студент": "student",
+    "teacher": "teacher", "преподаватель": "teacher",
+    "grade": "grade", "оценка": "grade",
+}
+AUDIT_ACTIONS = {"add": "➕", "update": "✏️", "delete": "🗑️"}
+
+def format_audit_event(event: Dict) -> str:
+    line = f"{AUDIT_ACTIONS.get(event['action'], event['action'])} #{event['entity_id']} "
+    line += f"{event['created_at']:%Y-%m-%d %H:%M:%S} (чат {event['chat_id']})\n"
+    before, after = event.get('before_data') or {}, event.get('after_data') or {}
+    if before and after:
+        changes = [f"  {key}: {before.get(key)} → {after.get(key)}" for key in after if before.get(key) != after.get(key)]
+        line += "\n".join(changes) if changes else "  без изменений"
+    else:
+        row = after or before
+        line += "  " + ", ".join(f"{key}={value}" for key, value in row.items() if key != 'id')
+    return line
+
+@bot.message_handler(commands=['audit'])
+def show_audit(message):
+    # В журнале чужие chat_id и строки целиком, включая email и телефоны
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        bot.send_message(message.chat.id, "⛔ Команда доступна только администраторам")
+        return
+    args = message.text.split()[1:]
+    try:
+        entity = AUDIT_ENTITIES.get(args[0].lower()) if args else None
+        entity_id = int(args[1]) if len(args) > 1 else None
+    except ValueError:
+        entity = None
+    if not entity:
+        bot.send_message(
+            message.chat.id,
+            "📜 Использование: /audit <student|teacher|grade> [ID]\n\n"
+            "Пример:\n/audit grade 1"
+        )
+        return
+    try:
+        # Показываем и события, которые еще ждут записи в очереди
+        audit_log.flush()
+        events = db.get_audit_log(entity, entity_id)
+        if not events:
+            bot.send_message(message.chat.id, "❌ Изменений не найдено")
+            return
+
+        response = "📜 ПОСЛЕДНИЕ ИЗМЕНЕНИЯ:\n\n"
+        for event in events:
+            response += format_audit_event(event) + "\n"
+            response += "─" * 20 + "\n"
+        bot.send_message(message.chat.id, response)
+    except Exception as e:
+        bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
+
+# ПОДПИСКИ НА ОЦЕНКИ
+SUBSCRIPTION_TARGETS = {
+    "student": "student", "студент": "student",
+    "group": "group", "группа": "group",
+}
+
+def parse_subscription_args(message):
+    args = message.text.split()[1:]
+    if len(args) < 2 or args[0].lower() not in SUBSCRIPTION_TARGETS:
+        return None, None
+    try:
+        return SUBSCRIPTION_TARGETS[args[0].lower()], int(args[1])
+    except ValueError:
+        return None, None
+
+@bot.message_handler(commands=['subscribe'])
+def subscribe(message):
+    target_type, target_id = parse_subscription_args(message)
+    if not target_type:
+        bot.send_message(
+            message.chat.id,
+            "🔔 Использование: /subscribe <student|group> <ID>\n\n"
+            "Пример:\n/subscribe group 1"
+        )
+        return
+    try:
+        if target_type == "student":
+            found = db.get_students_by_ids([target_id])
+        else:
+            found = db.get_groups_by_ids([target_id])
+        if not found:
+            bot.send_message(message.chat.id, "❌ Не найдено")
+        elif notifier.subscribe(message.chat.id, target_type, target_id):
+            bot.send_message(message.chat.id, "✅ Подписка оформлена! Новые оценки будут приходить сюда")
+        else:
+            bot.send_message(message.chat.id, "❌ Ошибка при оформлении подписки")
+    except Exception as e:
+        bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
+
+@bot.message_handler(commands=['unsubscribe'])
+def unsubscribe(message):
+    target_type, target_id = parse_subscription_args(message)
+    # Без аргументов - отписка от всего
+    if len(message.text.split()) > 1 and not target_type:
+        bot.send_message(message.chat.id, "🔕 Использование: /unsubscribe [<student|group> <ID>]")
+        return
+    try:
+        if notifier.unsubscribe(message.chat.id, target_type, target_id):
+            bot.send_message(message.chat.id, "✅ Подписка отменена")
+        else:
+            bot.send_message(message.chat.id, "❌ Ошибка при отмене подписки")
+    except Exception as e:
+        bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
+
+@bot.message_handler(commands=['subscriptions'])
+def list_subscriptions(message):
+    subscriptions = notifier.chat_subscriptions(message.chat.id)
+    if not subscriptions:
+        bot.send_message(message.chat.id, "🔕 Подписок нет. Оформить: /subscribe <student|group> <ID>")
+        return
+    names = {"student": "🎓 Студент", "group": "🏫 Группа"}
+    response = "🔔 ПОДПИСКИ:\n\n"
+    response += "\n".join(f"{names[target_type]} #{target_id}" for target_type, target_id in subscriptions)
+    bot.send_message(message.chat.id, response)
+
+# ПРОФИЛИРОВАНИЕ (только администраторы)
+@bot.message_handler(commands=['profile'])
+def run_profile(message):
+    if message.chat.id not in ADMIN_CHAT_IDS:
+        bot.send_message(message.chat.id, "⛔ Команда доступна только администраторам")
+        return
+    args = message.text.split()[1:]
+    try:
+        seconds = min(float(args[0]), PROFILE_MAX_SECONDS) if args else 30.0
+    except ValueError:
+        seconds = 0
+    mode = args[1].lower() if len(args) > 1 else "all"
+    if seconds <= 0 or mode not in ("cpu", "mem", "all"):
+        bot.send_message(
+            message.chat.id,
+            "🔬 Использование: /profile [секунды] [cpu|mem|all]\n\n"
+            "Пример:\n/profile 30 cpu"
+        )
+        return
+
+    def send_report(report: str):
+        try:
+            bot.send_document(message.chat.id, io.BytesIO(report.encode("utf-8")),
+                              caption="🔬 Профиль готов",
+                              visible_file_name=f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        except Exception as e:
+            print(f"❌ Не удалось отправить профиль: {e}")
+
+    if not profiler.start(seconds, cpu=mode in ("cpu", "all"), memory=mode in ("mem", "all"), on_done=send_report):
+        bot.send_message(message.chat.id, "⏳ Профиль уже выполняется, дождитесь результата")
+        return
+    bot.send_message(message.chat.id, f"🔬 Профилирование запущено на {seconds:g} сек...")
+
 # ПРОСМОТР ДАННЫХ
 @bot.message_handler(func=lambda message: message.text == "🎓 Все студенты")
 def all_students(message):
@@ -284,6 +354,7 @@ def all_students(message):
             response += f"\n... и еще {len(students) - 15} студентов"
             
         bot.send_message(message.chat.id, response)
+        reply_cache.store(message.text, response)
     except Exception as e:
         bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
 
@@ -304,6 +375,7 @@ def all_teachers(message):
             response += "─" * 20 + "\n"
         
         bot.send_message(message.chat.id, response)
+        reply_cache.store(message.text, response)
     except Exception as e:
         bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
 
@@ -327,6 +399,7 @@ def all_grades(message):
             response += f"\n... и еще {len(grades) - 10} оценок"
             
         bot.send_message(message.chat.id, response)
+        reply_cache.store(message.text, response)
     except Exception as e:
         bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
 
@@ -367,9 +440,9 @@ def add_teacher_start(message):
 def add_grade_start(message):
     user_states[message.chat.id] = "awaiting_grade_data"
     
-    students = db.get_all_students()[:10]
-    subjects = db.get_all_subjects()[:10]
-    teachers = db.get_all_teachers()[:10]
+    students = db.get_all_students(limit=10)
+    subjects = db.get_all_subjects(limit=10)
+    teachers = db.get_all_teachers(limit=10)
     
     students_info = "\n".join([f"#{s['id']} - {s['first_name']} {s['last_name']}" for s in students])
     subjects_info = "\n".join([f"#{s['id']} - {s['name']}" for s in subjects])
@@ -384,7 +457,9 @@ def add_grade_start(message):
         f"Введите данные в формате:\n"
         f"<ID_студента> <ID_предмета> <Оценка> <ID_преподавателя>\n\n"
         f"Пример:\n1 1 5 1\n\n"
-        f"Оценка: от 1 до 5"
+        f"Оценка: от 1 до 5\n"
+        f"Для нескольких оценок (например, всей группе) - по одной строке на оценку\n\n"
+        f"{inline_search_hint()}"
     )
 
 # РЕДАКТИРОВАНИЕ ДАННЫХ
@@ -392,7 +467,7 @@ def add_grade_start(message):
 def edit_student_start(message):
     user_states[message.chat.id] = "awaiting_student_edit"
     
-    students = db.get_all_students()[:10]
+    students = db.get_all_students(limit=10)
     groups = db.get_all_groups()
     
     students_info = "\n".join([f"#{s['id']} - {s['first_name']} {s['last_name']}" for s in students])
@@ -412,7 +487,7 @@ def edit_student_start(message):
 def edit_teacher_start(message):
     user_states[message.chat.id] = "awaiting_teacher_edit"
     
-    teachers = db.get_all_teachers()[:10]
+    teachers = db.get_all_teachers(limit=10)
     departments = db.get_all_departments()
     
     teachers_info = "\n".join([f"#{t['id']} - {t['first_name']} {t['last_name']}" for t in teachers])
@@ -432,7 +507,7 @@ def edit_teacher_start(message):
 def edit_grade_start(message):
     user_states[message.chat.id] = "awaiting_grade_edit"
     
-    grades = db.get_all_grades()[:10]
+    grades = db.get_all_grades(limit=10)
     grades_info = "\n".join([f"#{g['id']} - {g['student_first_name']} {g['student_last_name']}: {g['grade']} по {g['subject_name']}" for g in grades])
     
     bot.send_message(
@@ -442,7 +517,8 @@ def edit_grade_start(message):
         f"Введите данные в формате:\n"
         f"<ID_оценки> <Новая_оценка>\n\n"
         f"Пример:\n1 5\n\n"
-        f"Оценка: от 1 до 5"
+        f"Оценка: от 1 до 5\n\n"
+        f"{inline_search_hint()} - покажу оценки выбранного студента"
     )
 
 # УДАЛЕНИЕ ДАННЫХ
@@ -450,7 +526,7 @@ def edit_grade_start(message):
 def delete_student_start(message):
     user_states[message.chat.id] = "awaiting_student_delete"
     
-    students = db.get_all_students()[:10]
+    students = db.get_all_students(limit=10)
     students_info = "\n".join([f"#{s['id']} - {s['first_name']} {s['last_name']}" for s in students])
     
     bot.send_message(
@@ -465,7 +541,7 @@ def delete_student_start(message):
 def delete_teacher_start(message):
     user_states[message.chat.id] = "awaiting_teacher_delete"
     
-    teachers = db.get_all_teachers()[:10]
+    teachers = db.get_all_teachers(limit=10)
     teachers_info = "\n".join([f"#{t['id']} - {t['first_name']} {t['last_name']}" for t in teachers])
     
     bot.send_message(
@@ -480,7 +556,7 @@ def delete_teacher_start(message):
 def delete_grade_start(message):
     user_states[message.chat.id] = "awaiting_grade_delete"
     
-    grades = db.get_all_grades()[:10]
+    grades = db.get_all_grades(limit=10)
     grades_info = "\n".join([f"#{g['id']} - {g['student_first_name']} {g['student_last_name']}: {g['grade']} по {g['subject_name']}" for g in grades])
     
     bot.send_message(
@@ -488,9 +564,50 @@ def delete_grade_start(message):
         f"🗑️ УДАЛЕНИЕ ОЦЕНКИ\n\n"
         f"Оценки:\n{grades_info}\n\n"
         f"Введите ID оценки для удаления:\n\n"
-        f"Пример:\n1"
+        f"Пример:\n1\n\n"
+        f"{inline_search_hint()} - покажу оценки выбранного студента"
     )
 
+# ПОИСК ПО ИМЕНИ (inline-режим: @бот начало имени)
+INLINE_ICONS = {"student": "🎓", "teacher": "👨‍🏫", "subject": "📖"}
+INLINE_CHOICE = re.compile(r"^(🎓|👨‍🏫|📖) #(\d+) ")
+
+def inline_search_hint() -> str:
+    return f"🔎 Найти ID по имени: наберите @{bot.user.username} и начало имени"
+
+# Ответ только из индекса в памяти, без запросов к БД
+@bot.inline_handler(func=lambda query: True)
+def inline_search(query):
+    if not name_index.index.loaded:
+        bot.answer_inline_query(query.id, [], cache_time=1)
+        return
+    results = [
+        InlineQueryResultArticle(
+            id=f"{kind}:{entity_id}",
+            title=f"{INLINE_ICONS[kind]} {name}",
+            description=f"#{entity_id} · {description}",
+            input_message_content=InputTextMessageContent(f"{INLINE_ICONS[kind]} #{entity_id} {name}")
+        )
+        for kind, entity_id, name, description in name_index.search(query.query)
+    ]
+    bot.answer_inline_query(query.id, results, cache_time=5, is_personal=False)
+
+# Выбранный в inline-режиме результат - это подсказка, а не ввод данных.
+# При редактировании и удалении оценки показываем оценки выбранного студента
+@bot.message_handler(func=lambda message: message.via_bot is not None and message.via_bot.id == bot.user.id)
+def inline_choice(message):
+    match = INLINE_CHOICE.match(message.text or "")
+    state = user_states.get(message.chat.id)
+    if not match or match.group(1) != "🎓" or state not in ("awaiting_grade_edit", "awaiting_grade_delete"):
+        return
+    year_start, year_end = current_academic_year()
+    grades = db.get_student_grades(int(match.group(2)), date_from=year_start, date_to=year_end)
+    if not grades:
+        bot.send_message(message.chat.id, "❌ У студента нет оценок за текущий учебный год")
+        return
+    grades_info = "\n".join([f"#{g['id']} - {g['subject_name']}: {g['grade']} ({g['exam_date']})" for g in grades[:30]])
+    bot.send_message(message.chat.id, f"📚 Оценки студента за {year_start.year}/{year_end.year} учебный год:\n{grades_info}")
+
 # ОБРАБОТКА ВВЕДЕННЫХ ДАННЫХ
 @bot.message_handler(func=lambda message: user_states.get(message.chat.id))
 def handle_user_input(message):
@@ -501,29 +618,39 @@ def handle_user_input(message):
         # ДОБАВЛЕНИЕ
         if state == "awaiting_student_data" and len(data) >= 5:
             first_name, last_name, email, phone, group_id = data[0], data[1], data[2], data[3], int(data[4])
-            if db.add_student(first_name, last_name, email, phone, group_id):
+            if db.add_student(first_name, last_name, email, phone, group_id, chat_id=message.chat.id):
                 bot.send_message(message.chat.id, "✅ Студент успешно добавлен!")
             else:
                 bot.send_message(message.chat.id, "❌ Ошибка при добавлении студента")
                 
         elif state == "awaiting_teacher_data" and len(data) >= 5:
             first_name, last_name, email, phone, dept_id = data[0], data[1], data[2], data[3], int(data[4])
-            if db.add_teacher(first_name, last_name, email, phone, dept_id):
+            if db.add_teacher(first_name, last_name, email, phone, dept_id, chat_id=message.chat.id):
                 bot.send_message(message.chat.id, "✅ Преподаватель успешно добавлен!")
             else:
                 bot.send_message(message.chat.id, "❌ Ошибка при добавлении преподавателя")
                 
         elif state == "awaiting_grade_data" and len(data) >= 4:
-            student_id, subject_id, grade, teacher_id = int(data[0]), int(data[1]), int(data[2]), int(data[3])
-            student = db.get_student_by_id(student_id)
-            teacher = db.get_teacher_by_id(teacher_id)
-            if not student:
-                bot.send_message(message.chat.id, "❌ Студент с таким ID не найден")
-            elif not teacher:
-                bot.send_message(message.chat.id, "❌ Преподаватель с таким ID не найден")
-            elif 1 <= grade <= 5:
-                if db.add_grade(student_id, subject_id, grade, teacher_id):
-                    bot.send_message(message.chat.id, "✅ Оценка успешно добавлена!")
+            # Каждая строка - отдельная оценка; все строки проверяются и сохраняются вместе
+            grades = []
+            for line in message.text.splitlines():
+                values = line.split()
+                if values:
+                    grades.append((int(values[0]), int(values[1]), int(values[2]), int(values[3])))
+            students = db.get_students_by_ids({g[0] for g in grades})
+            teachers = db.get_teachers_by_ids({g[3] for g in grades})
+            missing_students = sorted({g[0] for g in grades} - students.keys())
+            missing_teachers = sorted({g[3] for g in grades} - teachers.keys())
+            if missing_students:
+                bot.send_message(message.chat.id, f"❌ Студент с таким ID не найден: {', '.join(map(str, missing_students))}")
+            elif missing_teachers:
+                bot.send_message(message.chat.id, f"❌ Преподаватель с таким ID не найден: {', '.join(map(str, missing_teachers))}")
+            elif all(1 <= g[2] <= 5 for g in grades):
+                if db.add_grades(grades, chat_id=message.chat.id):
+                    if len(grades) == 1:
+                        bot.send_message(message.chat.id, "✅ Оценка успешно добавлена!")
+                    else:
+                        bot.send_message(message.chat.id, f"✅ Добавлено оценок: {len(grades)}")
                 else:
                     bot.send_message(message.chat.id, "❌ Ошибка при добавлении оценки")
             else:
@@ -532,14 +659,14 @@ def handle_user_input(message):
         # РЕДАКТИРОВАНИЕ
         elif state == "awaiting_student_edit" and len(data) >= 6:
             student_id, first_name, last_name, email, phone, group_id = int(data[0]), data[1], data[2], data[3], data[4], int(data[5])
-            if db.update_student(student_id, first_name, last_name, email, phone, group_id):
+            if db.update_student(student_id, first_name, last_name, email, phone, group_id, chat_id=message.chat.id):
                 bot.send_message(message.chat.id, "✅ Студент успешно обновлен!")
             else:
                 bot.send_message(message.chat.id, "❌ Ошибка при обновлении студента")
                 
         elif state == "awaiting_teacher_edit" and len(data) >= 6:
             teacher_id, first_name, last_name, email, phone, dept_id = int(data[0]), data[1], data[2], data[3], data[4], int(data[5])
-            if db.update_teacher(teacher_id, first_name, last_name, email, phone, dept_id):
+            if db.update_teacher(teacher_id, first_name, last_name, email, phone, dept_id, chat_id=message.chat.id):
                 bot.send_message(message.chat.id, "✅ Преподаватель успешно обновлен!")
             else:
                 bot.send_message(message.chat.id, "❌ Ошибка при обновлении преподавателя")
@@ -547,7 +674,7 @@ def handle_user_input(message):
         elif state == "awaiting_grade_edit" and len(data) >= 2:
             grade_id, new_grade = int(data[0]), int(data[1])
             if 1 <= new_grade <= 5:
-                if db.update_grade(grade_id, new_grade):
+                if db.update_grade(grade_id, new_grade, chat_id=message.chat.id):
                     bot.send_message(message.chat.id, "✅ Оценка успешно обновлена!")
                 else:
                     bot.send_message(message.chat.id, "❌ Ошибка при обновлении оценки")
@@ -557,21 +684,21 @@ def handle_user_input(message):
         # УДАЛЕНИЕ
         elif state == "awaiting_student_delete" and len(data) >= 1:
             student_id = int(data[0])
-            if db.delete_student(student_id):
+            if db.delete_student(student_id, chat_id=message.chat.id):
                 bot.send_message(message.chat.id, "✅ Студент успешно удален!")
             else:
                 bot.send_message(message.chat.id, "❌ Ошибка при удалении студента")
                 
         elif state == "awaiting_teacher_delete" and len(data) >= 1:
             teacher_id = int(data[0])
-            if db.delete_teacher(teacher_id):
+            if db.delete_teacher(teacher_id, chat_id=message.chat.id):
                 bot.send_message(message.chat.id, "✅ Преподаватель успешно удален!")
             else:
                 bot.send_message(message.chat.id, "❌ Ошибка при удалении преподавателя")
                 
         elif state == "awaiting_grade_delete" and len(data) >= 1:
             grade_id = int(data[0])
-            if db.delete_grade(grade_id):
+            if db.delete_grade(grade_id, chat_id=message.chat.id):
                 bot.send_message(message.chat.id, "✅ Оценка успешно удалена!")
             else:
                 bot.send_message(message.chat.id, "❌ Ошибка при удалении оценки")
@@ -606,6 +733,7 @@ def show_stats(message):
         response += f"📈 Всего записей: {len(students) + len(teachers) + len(grades)}"
         
         bot.send_message(message.chat.id, response)
+        reply_cache.store(message.text, response)
     except Exception as e:
         bot.send_message(message.chat.id, f"❌ Ошибка: {e}")
 
@@ -634,13 +762,35 @@ if __name__ == "__main__":
         exit(1)
     
     print("✅ Интернет-соединение есть")
-    
-    # Сброс вебхука перед запуском
+
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
+    # kill -USR1 <pid>: профиль на 30 сек в файл, если бот не отвечает на команды
+    if hasattr(signal, "SIGUSR1"):
+        def write_profile(report: str):
+            path = f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(report)
+            print(f"🔬 Профиль сохранен в {path}")
+
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start(30, True, True, write_profile))
+    notifier.start()
+    name_index.start()
+    # Индекс загружаем после подписки на изменения: ее первое подключение не вызывает
+    # повторную загрузку, а изменения, сделанные во время загрузки, не теряются
+    if db.changes:
+        db.changes.connected.wait(timeout=10)
+    name_index.load()
+    
+    # Сброс вебхука перед запуском (накопившиеся обновления сохраняются и будут обработаны)
     try:
-        requests.get(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates?offset=-1", timeout=10)
+        bot.remove_webhook()
         print("🔄 Вебхук сброшен")
     except Exception as e:
         print(f"⚠️ Не удалось сбросить вебхук: {e}")
+
+    poller = UpdatePoller(bot, UpdateCheckpoint(UPDATE_STATE_FILE), workers=BOT_WORKERS)
     
     # Добавляем обработку сетевых ошибок
     max_retries = 5
@@ -650,13 +800,9 @@ if __name__ == "__main__":
         try:
             print(f"🔄 Попытка запуска {attempt + 1} из {max_retries}...")
             
-            bot.polling(
-                none_stop=True, 
-                skip_pending=True, 
-                interval=3,
-                timeout=30,
-                long_polling_timeout=20
-            )
+            # Попытки - только на запуск: ошибки во время работы poller повторяет сам
+            bot.get_me()
+            poller.run()
             
         except requests.exceptions.ConnectTimeout as e:
             print(f"❌ Таймаут подключения: {e}")
@@ -687,7 +833,10 @@ if __name__ == "__main__":
         print("❌ Не удалось запустить бота после нескольких попыток")
         print("💡 Проверьте интернет-соединение и VPN/прокси")
     
-    # Закрываем соединение с БД
-    if hasattr(db, 'connection') and db.connection:
-        db.connection.close()
-        print("✅ Соединение с БД закрыто")
\ No newline at end of file
+    # Дописываем журнал аудита и закрываем соединение с БД
+    poller.stop()
+    notifier.stop()
+    name_index.stop()
+    audit_log.close()
+    db.close()
+    print("✅ Соединение с БД закрыто")
\ No newline at end of file
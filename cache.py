@@ -0,0 +1,162 @@
+import json
+import select
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from create_tables import CHANGE_NOTIFY_TABLES
+from metrics import Counter, Gauge
+
+CHANGE_CHANNEL = "college_changes"
+
+CACHE_REQUESTS = Counter("college_bot_cache_requests_total", "Обращения к кэшу: hit, miss, bypass")
+CACHE_NOTIFICATIONS = Counter("college_bot_cache_notifications_total", "Полученные уведомления об изменениях")
+CACHE_LISTENER_CONNECTED = Gauge("college_bot_cache_listener_connected", "Подписка на изменения активна: 1 или 0")
+
+
+# Слушает LISTEN college_changes (триггеры из create_tables.py) и ведет счетчики версий по сущностям.
+# Читатель запоминает версию до запроса и сравнивает с текущей: не совпала - данные устарели.
+# Подписка считается активной, только если на всех таблицах есть триггеры уведомлений:
+# без них чужие записи не видны, и кэш остается выключенным
+class ChangeListener:
+    def __init__(self, dsn: str, channel: str = CHANGE_CHANNEL, reconnect_delay: float = 5.0,
+                 tables: Tuple[str, ...] = tuple(CHANGE_NOTIFY_TABLES), trigger_check_interval: float = 60.0):
+        self.dsn = dsn
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.tables = tables
+        self.trigger_check_interval = trigger_check_interval
+        self.versions: Dict[str, int] = defaultdict(int)
+        # Растет при каждом переподключении: уведомления за время разрыва потеряны
+        self.epoch = 0
+        # Когда (time.monotonic) сущность менялась последний раз - с этого момента
+        # реплика должна догнать основной сервер, чтобы с нее можно было заполнять кэш
+        self.changed_at: Dict[str, float] = defaultdict(float)
+        self.epoch_at = 0.0
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        # callback(entity, entity_id, op); entity None - устарело все
+        self.callbacks: List[Callable[[Optional[str], Optional[int], Optional[str]], None]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="db-listener", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def version(self, *entities: str) -> Tuple[int, ...]:
+        with self.lock:
+            return (self.epoch,) + tuple(self.versions[entity] for entity in entities)
+
+    def last_change(self, *entities: str) -> float:
+        with self.lock:
+            return max([self.epoch_at] + [self.changed_at[entity] for entity in entities])
+
+    # Свои записи отмечаем сразу, не дожидаясь собственного уведомления (read-your-writes)
+    def touch(self, entity: Optional[str]):
+        now = time.monotonic()
+        with self.lock:
+            if entity is None:
+                self.epoch += 1
+                self.epoch_at = now
+            else:
+                self.versions[entity] += 1
+                self.changed_at[entity] = now
+
+    def _publish(self, entity: Optional[str], entity_id: int = None, op: str = None):
+        self.touch(entity)
+        for callback in self.callbacks:
+            try:
+                callback(entity, entity_id, op)
+            except Exception as e:
+                print(f"❌ Change callback error: {e}")
+
+    def _missing_triggers(self, cursor) -> List[str]:
+        cursor.execute("""
+        SELECT c.relname FROM pg_trigger t JOIN pg_class c ON c.oid = t.tgrelid
+        WHERE t.tgname = c.relname || '_notify_change' AND t.tgenabled <> 'D'
+          AND pg_table_is_visible(c.oid) AND c.relname = ANY(%s)
+        """, (list(self.tables),))
+        present = {row[0] for row in cursor.fetchall()}
+        return [table for table in self.tables if table not in present]
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            delay = self.reconnect_delay
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    missing = self._missing_triggers(cursor)
+                    if not missing:
+                        cursor.execute(f"LISTEN {self.channel}")
+                if missing:
+                    print(f"⚠️ Нет триггеров уведомлений на {', '.join(missing)} "
+                          f"(запустите create_tables.py): кэш отключен")
+                    delay = self.trigger_check_interval
+                else:
+                    # Все, что закэшировано до подписки, могло устареть
+                    self._publish(None)
+                    self.connected.set()
+                    CACHE_LISTENER_CONNECTED.set(1)
+                    while not self._stop.is_set():
+                        if select.select([conn], [], [], 1.0)[0]:
+                            conn.poll()
+                            while conn.notifies:
+                                self._handle(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as e:
+                print(f"⚠️ Подписка на изменения прервана: {e}")
+            finally:
+                self.connected.clear()
+                CACHE_LISTENER_CONNECTED.set(0)
+                if conn is not None:
+                    conn.close()
+            self._stop.wait(delay)
+
+    def _handle(self, payload: str):
+        try:
+            change = json.loads(payload)
+            entity = change['entity']
+        except (ValueError, KeyError, TypeError):
+            print(f"⚠️ Непонятное уведомление об изменении: {payload}")
+            return
+        CACHE_NOTIFICATIONS.inc(entity=entity)
+        self._publish(entity, change.get('id'), change.get('op'))
+
+
+# Результаты чтения с версиями сущностей, от которых они зависят.
+# Пока подписка не активна, кэш не используется: инвалидацию мы бы не увидели.
+# Возвращается общий объект - вызывающий код не должен его изменять
+class VersionedCache:
+    def __init__(self, changes: ChangeListener, max_entries: int = 256):
+        self.changes = changes
+        self.max_entries = max_entries
+        self.entries: Dict[Hashable, Tuple[Tuple[int, ...], Any]] = {}
+        self.lock = threading.Lock()
+
+    def get_or_load(self, name: str, key: Hashable, entities: Tuple[str, ...], loader: Callable[[], Any]) -> Any:
+        if not self.changes.connected.is_set():
+            CACHE_REQUESTS.inc(method=name, result="bypass")
+            return loader()
+        # Версию берем до запроса: изменение во время чтения сделает запись устаревшей сразу
+        version = self.changes.version(*entities)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] == version:
+            CACHE_REQUESTS.inc(method=name, result="hit")
+            return entry[1]
+
+        CACHE_REQUESTS.inc(method=name, result="miss")
+        value = loader()
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[key] = (version, value)
+        return value
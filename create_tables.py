@@ -1,3 +1,6 @@
+import sys
+from datetime import date
+
 import psycopg2
 from psycopg2 import sql
 
@@ -83,18 +86,66 @@ def create_tables():
         )
         """)
         
-        # Таблица оценок
+        # Таблица оценок: разделы по учебным годам (exam_date), старые базы переводятся миграцией
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS grades (
-            id SERIAL PRIMARY KEY,
+            id SERIAL,
             student_id INTEGER REFERENCES students(id),
             subject_id INTEGER REFERENCES subjects(id),
             grade INTEGER CHECK (grade BETWEEN 1 AND 5),
+            exam_date DATE NOT NULL DEFAULT CURRENT_DATE,
+            teacher_id INTEGER REFERENCES teachers(id),
+            PRIMARY KEY (id, exam_date)
+        ) PARTITION BY RANGE (exam_date)
+        """)
+        migrate_grades_to_partitions(cursor)
+        ensure_grade_partitions(cursor)
+
+        # Архив оценок выпустившихся групп
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS grades_archive (
+            id INTEGER PRIMARY KEY,
+            student_id INTEGER,
+            subject_id INTEGER,
+            grade INTEGER,
             exam_date DATE,
-            teacher_id INTEGER REFERENCES teachers(id)
+            teacher_id INTEGER,
+            archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
         )
         """)
-        
+
+        # Подписки на уведомления об оценках студента или группы
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id BIGINT NOT NULL,
+            target_type VARCHAR(10) NOT NULL CHECK (target_type IN ('student', 'group')),
+            target_id INTEGER NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (chat_id, target_type, target_id)
+        )
+        """)
+
+        # Журнал изменений (только добавление записей)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id BIGSERIAL PRIMARY KEY,
+            chat_id BIGINT,
+            action VARCHAR(10) NOT NULL,
+            entity VARCHAR(20) NOT NULL,
+            entity_id INTEGER,
+            before_data JSONB,
+            after_data JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """)
+        cursor.execute("""
+        CREATE INDEX IF NOT EXISTS audit_log_entity_idx
+        ON audit_log (entity, entity_id, created_at DESC)
+        """)
+        cursor.execute("CREATE OR REPLACE RULE audit_log_no_update AS ON UPDATE TO audit_log DO INSTEAD NOTHING")
+        cursor.execute("CREATE OR REPLACE RULE audit_log_no_delete AS ON DELETE TO audit_log DO INSTEAD NOTHING")
+        create_change_triggers(cursor)
+
         conn.commit()
         print("✅ Все таблицы успешно созданы!")
         
@@ -109,6 +160,164 @@ def create_tables():
             cursor.close()
             conn.close()
 
+# Таблица -> (сущность, колонка с ID) для уведомлений об изменениях
+CHANGE_NOTIFY_TABLES = {
+    "departments": ("department", "id"),
+    "groups": ("group", "id"),
+    "students": ("student", "id"),
+    "teachers": ("teacher", "id"),
+    "subjects": ("subject", "id"),
+    "grades": ("grade", "id"),
+    "subscriptions": ("subscription", "chat_id"),
+}
+
+def create_change_triggers(cursor):
+    # После каждого изменения строки - NOTIFY college_changes с {"entity", "id", "op"}:
+    # по нему остальные экземпляры бота сбрасывают свои кэши
+    cursor.execute("""
+    CREATE OR REPLACE FUNCTION notify_college_change() RETURNS trigger AS $$
+    DECLARE
+        changed JSONB;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            changed := to_jsonb(OLD);
+        ELSE
+            changed := to_jsonb(NEW);
+        END IF;
+        PERFORM pg_notify('college_changes', json_build_object(
+            'entity', TG_ARGV[0],
+            'id', (changed ->> TG_ARGV[1])::bigint,
+            'op', lower(TG_OP)
+        )::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """)
+    for table, (entity, id_column) in CHANGE_NOTIFY_TABLES.items():
+        trigger = sql.Identifier(f"{table}_notify_change")
+        cursor.execute(sql.SQL("DROP TRIGGER IF EXISTS {} ON {}").format(trigger, sql.Identifier(table)))
+        cursor.execute(sql.SQL("""
+        CREATE TRIGGER {} AFTER INSERT OR UPDATE OR DELETE ON {}
+        FOR EACH ROW EXECUTE FUNCTION notify_college_change(%s, %s)
+        """).format(trigger, sql.Identifier(table)), (entity, id_column))
+
+def academic_year(day: date) -> int:
+    # Учебный год начинается 1 сентября
+    return day.year if day.month >= 9 else day.year - 1
+
+def grades_partitioned(cursor) -> bool:
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('grades')")
+    row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+def create_grade_partition(cursor, year: int):
+    name = f"grades_y{year}"
+    cursor.execute("SELECT to_regclass(%s)", (name,))
+    if cursor.fetchone()[0]:
+        return
+    start, end = date(year, 9, 1), date(year + 1, 9, 1)
+    table = sql.Identifier(name)
+    cursor.execute(sql.SQL("CREATE TABLE {} (LIKE grades INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(table))
+    # Строки этого года, попавшие в раздел по умолчанию, переносим в новый раздел
+    cursor.execute(sql.SQL("""
+    WITH moved AS (
+        DELETE FROM grades_default WHERE exam_date >= %s AND exam_date < %s RETURNING *
+    )
+    INSERT INTO {} SELECT * FROM moved
+    """).format(table), (start, end))
+    cursor.execute(sql.SQL("ALTER TABLE grades ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(table),
+                   (start, end))
+    print(f"🗂️ Создан раздел {name} ({start} - {end})")
+
+def ensure_grade_partitions(cursor, years_ahead: int = 1):
+    # Разделы на текущий и следующие учебные годы создаются заранее
+    if not grades_partitioned(cursor):
+        return
+    cursor.execute("CREATE TABLE IF NOT EXISTS grades_default PARTITION OF grades DEFAULT")
+    current = academic_year(date.today())
+    for year in range(current, current + years_ahead + 1):
+        create_grade_partition(cursor, year)
+
+def migrate_grades_to_partitions(cursor):
+    # Обычная таблица grades из старых версий переводится в секционированную
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('grades')")
+    if cursor.fetchone()[0] != 'r':
+        return
+    print("🔄 Перевод таблицы grades на разделы по учебным годам...")
+    cursor.execute("ALTER TABLE grades RENAME TO grades_legacy")
+    cursor.execute("ALTER TABLE grades_legacy RENAME CONSTRAINT grades_pkey TO grades_legacy_pkey")
+    cursor.execute("""
+    CREATE TABLE grades (
+        id INTEGER NOT NULL DEFAULT nextval('grades_id_seq'),
+        student_id INTEGER REFERENCES students(id),
+        subject_id INTEGER REFERENCES subjects(id),
+        grade INTEGER CHECK (grade BETWEEN 1 AND 5),
+        exam_date DATE NOT NULL DEFAULT CURRENT_DATE,
+        teacher_id INTEGER REFERENCES teachers(id),
+        PRIMARY KEY (id, exam_date)
+    ) PARTITION BY RANGE (exam_date)
+    """)
+    cursor.execute("ALTER SEQUENCE grades_id_seq OWNED BY grades.id")
+    cursor.execute("CREATE TABLE grades_default PARTITION OF grades DEFAULT")
+
+    cursor.execute("SELECT min(exam_date), max(exam_date) FROM grades_legacy")
+    first, last = cursor.fetchone()
+    if first:
+        for year in range(academic_year(first), academic_year(last) + 1):
+            create_grade_partition(cursor, year)
+    ensure_grade_partitions(cursor)
+
+    # Оценки без даты экзамена получают дату миграции (ключ раздела не может быть NULL)
+    cursor.execute("""
+    INSERT INTO grades (id, student_id, subject_id, grade, exam_date, teacher_id)
+    SELECT id, student_id, subject_id, grade, COALESCE(exam_date, CURRENT_DATE), teacher_id
+    FROM grades_legacy
+    """)
+    print(f"✅ Перенесено оценок: {cursor.rowcount}")
+    cursor.execute("DROP TABLE grades_legacy")
+
+def archive_graduated_grades(cursor, conn, batch_size: int = 10000) -> int:
+    # Оценки групп, чей end_date прошел, переносятся в grades_archive пачками,
+    # чтобы не держать долгие блокировки на горячих разделах
+    total = 0
+    while True:
+        cursor.execute("""
+        WITH moved AS (
+            DELETE FROM grades WHERE (id, exam_date) IN (
+                SELECT g.id, g.exam_date
+                FROM grades g
+                JOIN students s ON g.student_id = s.id
+                JOIN groups gr ON s.group_id = gr.id
+                WHERE gr.end_date < CURRENT_DATE
+                LIMIT %s
+            )
+            RETURNING id, student_id, subject_id, grade, exam_date, teacher_id
+        )
+        INSERT INTO grades_archive (id, student_id, subject_id, grade, exam_date, teacher_id)
+        SELECT * FROM moved
+        """, (batch_size,))
+        moved = cursor.rowcount
+        conn.commit()
+        total += moved
+        if moved < batch_size:
+            return total
+
+def maintain():
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_CONFIG)
+        cursor = conn.cursor()
+        ensure_grade_partitions(cursor)
+        conn.commit()
+        archived = archive_graduated_grades(cursor, conn)
+        print(f"📦 В архив перенесено оценок: {archived}")
+    except Exception as e:
+        print(f"❌ Ошибка обслуживания таблицы оценок: {e}")
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
 def add_test_data(cursor, conn):
     try:
         # Добавляем отделы
@@ -154,6 +363,7 @@ def add_test_data(cursor, conn):
         """)
         
         # Добавляем оценки
+        create_grade_partition(cursor, 2023)
         cursor.execute("""
         INSERT INTO grades (student_id, subject_id, grade, teacher_id, exam_date) 
         VALUES 
@@ -171,4 +381,9 @@ def add_test_data(cursor, conn):
         print(f"❌ Ошибка при добавлении тестовых данных: {e}")
 
 if __name__ == "__main__":
-    create_tables()
\ No newline at end of file
+    # python create_tables.py          - создание таблиц и миграции
+    # python create_tables.py maintain - новые разделы и архивация (для cron)
+    if len(sys.argv) > 1 and sys.argv[1] == "maintain":
+        maintain()
+    else:
+        create_tables()
\ No newline at end of file
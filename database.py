@@ -1,113 +1,941 @@
 import psycopg2
 from psycopg2.extras import RealDictCursor
-import logging
-from typing import List, Dict, Any
+from psycopg2.extensions import make_dsn, parse_dsn, QueryCanceledError
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from contextlib import contextmanager
+from collections import deque
+from datetime import date
+from typing import List, Dict, Any, Optional, Tuple
+import functools
+import itertools
+import random
+import threading
+import time
+import os
+from dotenv import load_dotenv
+from audit import AuditLog
+from batching import WriteBatcher
+from cache import ChangeListener, VersionedCache
+from create_tables import academic_year, ensure_grade_partitions
+from metrics import Counter, Gauge
+from models import Student, Teacher, Grade
+
+load_dotenv()
+
+# Настройки базы данных из .env
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST", "localhost"),
+    "database": os.getenv("DB_NAME", "college_db"),
+    "user": os.getenv("DB_USER", "postgres"), 
+    "password": os.getenv("DB_PASSWORD", "2008"),
+    "port": os.getenv("DB_PORT", "5432")
+}
+
+# Таймауты сокета: без них запрос к недоступному (пропавшему из сети) серверу висит до таймаута TCP в ОС - минуты.
+# connect_timeout - сек на подключение, keepalives - сек простоя до проверки, интервал и число проверок,
+# tcp_user_timeout - мс, сколько ждать подтверждения отправленных данных
+DB_SOCKET_OPTIONS = {
+    "connect_timeout": os.getenv("DB_CONNECT_TIMEOUT", "5"),
+    "keepalives": "1",
+    "keepalives_idle": os.getenv("DB_KEEPALIVES_IDLE", "10"),
+    "keepalives_interval": os.getenv("DB_KEEPALIVES_INTERVAL", "5"),
+    "keepalives_count": os.getenv("DB_KEEPALIVES_COUNT", "3"),
+    "tcp_user_timeout": os.getenv("DB_TCP_USER_TIMEOUT_MS", "30000"),
+}
+
+# Параметры, явно заданные в DSN, не перезаписываются
+def with_socket_options(dsn: str) -> str:
+    present = parse_dsn(dsn)
+    return make_dsn(dsn, **{key: value for key, value in DB_SOCKET_OPTIONS.items() if key not in present})
+
+# Основной сервер (запись) и реплики только для чтения (DSN через запятую)
+DB_PRIMARY_DSN = with_socket_options(os.getenv("DB_PRIMARY_DSN") or make_dsn(**DB_CONFIG))
+DB_REPLICA_DSNS = [with_socket_options(dsn.strip())
+                   for dsn in os.getenv("DB_REPLICA_DSNS", "").split(",") if dsn.strip()]
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+# Сколько ждать свободного соединения, когда все DB_POOL_SIZE заняты (сек)
+DB_POOL_WAIT = float(os.getenv("DB_POOL_WAIT", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "1"))
+DB_MAX_REPLICA_LAG_BYTES = int(os.getenv("DB_MAX_REPLICA_LAG_BYTES", str(16 * 1024 * 1024)))
+
+# Переподключение и предохранитель (circuit breaker)
+DB_QUERY_RETRIES = int(os.getenv("DB_QUERY_RETRIES", "2"))
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "3"))
+DB_RECONNECT_BASE_DELAY = float(os.getenv("DB_RECONNECT_BASE_DELAY", "0.5"))
+DB_RECONNECT_MAX_DELAY = float(os.getenv("DB_RECONNECT_MAX_DELAY", "30"))
+
+# Дедлайны (statement_timeout, мс): короткие для выбора и поиска, длинные для списков и статистики
+DB_TIMEOUT_LOOKUP_MS = int(os.getenv("DB_TIMEOUT_LOOKUP_MS", "2000"))
+DB_TIMEOUT_LISTING_MS = int(os.getenv("DB_TIMEOUT_LISTING_MS", "10000"))
+DB_TIMEOUT_WRITE_MS = int(os.getenv("DB_TIMEOUT_WRITE_MS", "5000"))
+# Общий бюджет времени на все запросы одного обработчика (сек)
+DB_HANDLER_DEADLINE = float(os.getenv("DB_HANDLER_DEADLINE", "20"))
+
+# Групповой коммит записей (мс окна сбора пачки, 0 - каждая запись своей транзакцией)
+DB_WRITE_BATCH_WINDOW_MS = float(os.getenv("DB_WRITE_BATCH_WINDOW_MS", "0"))
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "64"))
+
+# Кэш списков с инвалидацией через LISTEN/NOTIFY (триггеры из create_tables.py)
+DB_CACHE_ENABLED = os.getenv("DB_CACHE_ENABLED", "1") == "1"
+
+# Как часто проверять, что разделы grades на следующий учебный год созданы (сек)
+DB_PARTITION_CHECK_INTERVAL = float(os.getenv("DB_PARTITION_CHECK_INTERVAL", "86400"))
+# После неудачи (нет прав на CREATE, гонка двух экземпляров) повторяем не каждую секунду
+DB_PARTITION_RETRY_INTERVAL = float(os.getenv("DB_PARTITION_RETRY_INTERVAL", "300"))
+
+# Границы текущего учебного года [1 сентября, 1 сентября следующего года)
+def current_academic_year() -> Tuple[date, date]:
+    year = academic_year(date.today())
+    return date(year, 9, 1), date(year + 1, 9, 1)
+
+# Условие на exam_date: границы подставляются константами, поэтому
+# планировщик отбрасывает лишние разделы grades (partition pruning)
+EXAM_DATE_RANGE = "(%s::date IS NULL OR g.exam_date >= %s) AND (%s::date IS NULL OR g.exam_date < %s)"
+
+def parse_lsn(lsn: str) -> int:
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) | int(low, 16)
+
+DB_CIRCUIT_STATE = Gauge("college_bot_db_circuit_state", "Состояние предохранителя БД: 0 - closed, 1 - open, 2 - half_open")
+DB_CONNECTION_FAILURES = Counter("college_bot_db_connection_failures_total", "Сбои соединения с БД")
+DB_CIRCUIT_REJECTIONS = Counter("college_bot_db_circuit_rejections_total", "Запросы, отклоненные открытым предохранителем")
+DB_TIMEOUTS = Counter("college_bot_db_timeouts_total", "Запросы, прерванные по дедлайну")
+
+class DatabaseUnavailable(psycopg2.OperationalError):
+    pass
+
+class CircuitOpen(DatabaseUnavailable):
+    pass
+
+class PoolExhausted(DatabaseUnavailable):
+    pass
+
+class QueryTimeout(DatabaseUnavailable):
+    pass
+
+# Дедлайн операции: statement_timeout для всех ее запросов и счетчик таймаутов по имени метода.
+# Выборка с limit (подсказки в меню) считается короткой операцией
+def deadline(timeout_ms: int, limited_timeout_ms: int = None):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            local = self._local
+            # Во вложенных вызовах действует дедлайн внешней операции
+            if getattr(local, 'operation', None):
+                return method(self, *args, **kwargs)
+            local.operation = method.__name__
+            local.timeout_ms = limited_timeout_ms if limited_timeout_ms and kwargs.get('limit') else timeout_ms
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                local.operation = None
+                local.timeout_ms = None
+        return wrapper
+    return decorator
+
+# Кэширует результат метода, пока не изменились перечисленные сущности.
+# Значение загружается с реплики, только если она догнала основной сервер на момент последнего
+# изменения этих сущностей: иначе устаревшие данные остались бы в кэше под новой версией.
+# Подходящей реплики нет - читаем с основного сервера
+def cached(*entities: str):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.cache is None:
+                return method(self, *args, **kwargs)
+
+            def load():
+                with self.fresh_reads(self.changes.last_change(*entities)):
+                    return method(self, *args, **kwargs)
+
+            key = (method.__name__, args, tuple(sorted(kwargs.items())))
+            return self.cache.get_or_load(method.__name__, key, entities, load)
+        return wrapper
+    return decorator
+
+# Пока БД недоступна, запросы сразу отклоняются; повторные попытки - с растущей задержкой и джиттером
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+    STATE_CODES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.attempts = 0
+        self.retry_at = 0.0
+        self.lock = threading.Lock()
+        DB_CIRCUIT_STATE.set(0, node=name)
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            # Пробный запрос пропускаем один раз за период ожидания
+            if time.monotonic() >= self.retry_at:
+                self._set_state(self.HALF_OPEN)
+                self.retry_at = time.monotonic() + self._delay()
+                return True
+        DB_CIRCUIT_REJECTIONS.inc(node=self.name)
+        return False
+
+    def is_due(self) -> bool:
+        return self.state != self.CLOSED and time.monotonic() >= self.retry_at
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.attempts = 0
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+                print(f"✅ Соединение с БД ({self.name}) восстановлено")
+
+    def record_failure(self):
+        DB_CONNECTION_FAILURES.inc(node=self.name)
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= DB_BREAKER_FAILURES:
+                self.attempts += 1
+                self.retry_at = time.monotonic() + self._delay()
+                if self.state == self.CLOSED:
+                    print(f"🔌 БД ({self.name}) недоступна, запросы временно отклоняются")
+                self._set_state(self.OPEN)
+
+    def _delay(self) -> float:
+        delay = min(DB_RECONNECT_MAX_DELAY, DB_RECONNECT_BASE_DELAY * 2 ** max(self.attempts - 1, 0))
+        return random.uniform(delay / 2, delay)
+
+    def _set_state(self, state: str):
+        self.state = state
+        DB_CIRCUIT_STATE.set(self.STATE_CODES[state], node=self.name)
+
+# Сервер PostgreSQL со своим пулом соединений
+class DatabaseNode:
+    def __init__(self, name: str, dsn: str):
+        self.name = name
+        self.dsn = dsn
+        self.pool = None
+        self.lock = threading.Lock()
+        self.breaker = CircuitBreaker(name)
+        # getconn не ждет освобождения соединения, а бросает PoolError - ждем здесь
+        self.slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+        self.healthy = False
+        self.lag_bytes = None
+        # Момент, до которого реплика гарантированно видит все коммиты основного сервера
+        self.caught_up_at = 0.0
+
+    def open(self) -> bool:
+        try:
+            self._get_pool()
+            return True
+        except psycopg2.Error as e:
+            print(f"❌ Database connection failed ({self.name}): {e}")
+            self.breaker.record_failure()
+            return False
+
+    def _get_pool(self) -> ThreadedConnectionPool:
+        pool = self.pool
+        if pool is not None:
+            return pool
+        # Подключаемся без lock: зависшее подключение не должно задерживать остальные потоки
+        pool = ThreadedConnectionPool(1, DB_POOL_SIZE, self.dsn)
+        with self.lock:
+            if self.pool is None:
+                self.pool = pool
+                print(f"✅ Connected to PostgreSQL database ({self.name})")
+                return pool
+            current = self.pool
+        # Другой поток успел открыть пул раньше
+        pool.closeall()
+        return current
+
+    def _retire_pool(self, pool: ThreadedConnectionPool):
+        # После обрыва остальные соединения пула тоже, скорее всего, мертвы:
+        # следующий запрос откроет новый пул, старые соединения закроются по возврату
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+
+    @contextmanager
+    def connection(self):
+        if not self.breaker.allow():
+            raise CircuitOpen(f"База данных ({self.name}) временно недоступна, попробуйте позже")
+        if not self.slots.acquire(timeout=DB_POOL_WAIT):
+            raise PoolExhausted(f"Все соединения с базой данных ({self.name}) заняты, попробуйте позже")
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+        except (psycopg2.OperationalError, PoolError) as e:
+            self.slots.release()
+            if isinstance(e, PoolError):
+                raise PoolExhausted(f"Все соединения с базой данных ({self.name}) заняты, попробуйте позже") from e
+            self.breaker.record_failure()
+            raise DatabaseUnavailable(f"Нет соединения с базой данных ({self.name}): {e}") from e
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if conn.closed:
+                self.breaker.record_failure()
+                self._retire_pool(pool)
+            else:
+                self.breaker.record_success()
+            raise
+        except Exception:
+            self.breaker.record_success()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            try:
+                if pool is self.pool:
+                    # Разорванные соединения не возвращаем в пул
+                    pool.putconn(conn, close=bool(conn.closed))
+                else:
+                    conn.close()
+            finally:
+                self.slots.release()
+
+    def close(self):
+        with self.lock:
+            if self.pool:
+                self.pool.closeall()
+                self.pool = None
 
 class CollegeDatabase:
-    def __init__(self):
-        self.connection = None
+    def __init__(self, primary_dsn: str, replica_dsns: List[str] = None, audit_log: AuditLog = None):
+        self.primary = DatabaseNode("primary", primary_dsn)
+        self.replicas = [DatabaseNode(f"replica-{i + 1}", dsn) for i, dsn in enumerate(replica_dsns or [])]
+        self.audit_log = audit_log
+        # Подписчики на изменения: callback(chat_id, action, entity, rows)
+        self.write_listeners = []
+        self._local = threading.local()
+        self._round_robin = itertools.count()
+        # chat_id -> время последней записи (для read-your-writes)
+        self._last_write: Dict[int, float] = {}
+        # (время, LSN основного сервера) из последних проверок реплик
+        self._primary_lsns = deque(maxlen=120)
+        self._stop = threading.Event()
+        self.changes = ChangeListener(primary_dsn) if DB_CACHE_ENABLED else None
+        self.cache = VersionedCache(self.changes) if self.changes else None
+        self.batcher = WriteBatcher(self.primary, DB_WRITE_BATCH_WINDOW_MS, DB_WRITE_BATCH_MAX,
+                                    DB_TIMEOUT_WRITE_MS) if DB_WRITE_BATCH_WINDOW_MS > 0 else None
         self.connect()
-    
+        if self.changes:
+            self.changes.start()
+        threading.Thread(target=self._watch_nodes, name="db-watcher", daemon=True).start()
+
     def connect(self):
+        self.primary.open()
+        for replica in self.replicas:
+            replica.open()
+
+    def set_chat(self, chat_id: Optional[int]):
+        self._local.chat_id = chat_id
+
+    def set_deadline(self, deadline_at: Optional[float]):
+        # Момент (time.monotonic), после которого запросы текущего обработчика не выполняются
+        self._local.deadline_at = deadline_at
+
+    def _statement_timeout(self) -> Optional[int]:
+        timeout_ms = getattr(self._local, 'timeout_ms', None)
+        deadline_at = getattr(self._local, 'deadline_at', None)
+        if deadline_at is not None:
+            remaining_ms = int((deadline_at - time.monotonic()) * 1000)
+            if remaining_ms <= 0:
+                self._timed_out()
+            timeout_ms = min(timeout_ms, remaining_ms) if timeout_ms else remaining_ms
+        return timeout_ms
+
+    def _timed_out(self, cause: Exception = None):
+        operation = getattr(self._local, 'operation', None) or "query"
+        DB_TIMEOUTS.inc(operation=operation)
+        print(f"⏱️ Таймаут операции {operation}")
+        raise QueryTimeout("Запрос выполнялся слишком долго, попробуйте еще раз") from cause
+
+    def _run(self, node: DatabaseNode, query: str, params: tuple = None, idempotent: bool = False,
+             row_type: type = None) -> List[Dict]:
+        timeout_ms = self._statement_timeout()
+        if timeout_ms:
+            # SET LOCAL уходит тем же запросом и действует до конца транзакции
+            query = f"SET LOCAL statement_timeout = {int(timeout_ms)}; {query}"
+        for attempt in range(DB_QUERY_RETRIES + 1):
+            sent = broken = False
+            try:
+                with node.connection() as conn:
+                    try:
+                        # Со строковой моделью берем кортежи и сразу собираем компактные объекты
+                        with conn.cursor(cursor_factory=None if row_type else RealDictCursor) as cursor:
+                            sent = True
+                            cursor.execute(query, params or ())
+                            # Запросы с RETURNING возвращают строки и после изменения
+                            if not cursor.description:
+                                rows = []
+                            elif row_type:
+                                rows = [row_type(*values) for values in cursor]
+                            else:
+                                rows = cursor.fetchall()
+                        # Чтение тоже закрывает транзакцию, чтобы не держать снимок
+                        conn.commit()
+                        return rows
+                    except Exception:
+                        broken = bool(conn.closed)
+                        if not broken:
+                            conn.rollback()
+                        raise
+            except (CircuitOpen, PoolExhausted):
+                # Свободного соединения уже ждали DB_POOL_WAIT - повтор только задержит ответ
+                raise
+            except QueryCanceledError as e:
+                self._timed_out(e)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # Запись повторяем, только если она точно не дошла до сервера
+                retryable = not sent or (broken and idempotent)
+                if attempt >= DB_QUERY_RETRIES or not retryable:
+                    raise
+                time.sleep(random.uniform(0, DB_RECONNECT_BASE_DELAY * 2 ** attempt))
+
+    def execute_query(self, query: str, params: tuple = None, row_type: type = None) -> List[Dict]:
         try:
-            self.connection = psycopg2.connect(
-                host="localhost",
-                database="college_db",
-                user="your_username",
-                password="your_password",
-                port="5432"
-            )
-            logging.info("Connected to PostgreSQL database")
+            return self._run(self.primary, query, params, idempotent=query.strip().upper().startswith('SELECT'),
+                             row_type=row_type)
+        except DatabaseUnavailable:
+            raise
         except Exception as e:
-            logging.error(f"Database connection failed: {e}")
-    
-    def execute_query(self, query: str, params: tuple = None) -> List[Dict]:
-        try:
-            with self.connection.cursor(cursor_factory=RealDictCursor) as cursor:
-                cursor.execute(query, params or ())
-                if query.strip().upper().startswith('SELECT'):
-                    return cursor.fetchall()
-                self.connection.commit()
-                return []
+            print(f"❌ Query execution error: {e}")
+            return []
+
+    # Запись: через групповой коммит, если он включен, иначе отдельной транзакцией
+    def execute_write(self, query: str, params: tuple = None) -> List[Dict]:
+        if not self.batcher:
+            return self.execute_query(query, params)
+        try:
+            return self.batcher.submit(query, params, self._statement_timeout())
+        except DatabaseUnavailable:
+            raise
+        except (QueryCanceledError, TimeoutError) as e:
+            self._timed_out(e)
         except Exception as e:
-            logging.error(f"Query execution error: {e}")
+            print(f"❌ Query execution error: {e}")
             return []
+
+    def execute_read(self, query: str, params: tuple = None, row_type: type = None) -> List[Dict]:
+        replica = self._pick_replica()
+        if replica:
+            try:
+                return self._run(replica, query, params, idempotent=True, row_type=row_type)
+            except QueryTimeout:
+                # Повтор на основном сервере только удвоил бы ожидание
+                raise
+            except psycopg2.Error as e:
+                print(f"⚠️ Чтение с {replica.name} не удалось, используем основной сервер: {e}")
+                if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                    replica.healthy = False
+        return self.execute_query(query, params, row_type)
+
+    # Чтения внутри блока идут только на реплики, догнавшие основной сервер на момент since
+    # (time.monotonic), остальные - на основной сервер
+    @contextmanager
+    def fresh_reads(self, since: float):
+        previous = getattr(self._local, 'fresh_since', 0.0)
+        self._local.fresh_since = max(previous, since)
+        try:
+            yield
+        finally:
+            self._local.fresh_since = previous
+
+    # Чтения внутри блока идут на основной сервер: данные должны включать все, о чем уже пришло уведомление
+    def primary_reads(self):
+        return self.fresh_reads(float("inf"))
+
+    def _pick_replica(self) -> Optional[DatabaseNode]:
+        # Чат, который только что писал, читает только с реплик, успевших догнать его запись
+        last_write = self._last_write.get(getattr(self._local, 'chat_id', None), 0.0)
+        since = max(last_write, getattr(self._local, 'fresh_since', 0.0))
+        candidates = [r for r in self.replicas if r.healthy and r.caught_up_at >= since]
+        if not candidates:
+            return None
+        return candidates[next(self._round_robin) % len(candidates)]
+
+    def _watch_nodes(self):
+        next_partition_check = time.monotonic()
+        while not self._stop.wait(min(DB_REPLICA_CHECK_INTERVAL, 1.0)):
+            if time.monotonic() >= next_partition_check:
+                ok = self.ensure_grade_partitions()
+                next_partition_check = time.monotonic() + (DB_PARTITION_CHECK_INTERVAL if ok else DB_PARTITION_RETRY_INTERVAL)
+            # Пробный запрос к упавшему серверу: восстановление замечаем и без трафика
+            for node in [self.primary] + self.replicas:
+                if node.breaker.is_due():
+                    try:
+                        self._run(node, "SELECT 1", idempotent=True)
+                    except psycopg2.Error:
+                        pass
+            self.check_replicas()
+
+    def ensure_grade_partitions(self) -> bool:
+        try:
+            with self.primary.connection() as conn:
+                try:
+                    with conn.cursor() as cursor:
+                        ensure_grade_partitions(cursor)
+                    conn.commit()
+                except psycopg2.Error:
+                    conn.rollback()
+                    raise
+            return True
+        except CircuitOpen:
+            return False
+        except psycopg2.Error as e:
+            print(f"⚠️ Не удалось создать разделы оценок: {e}")
+            return False
+
+    def check_replicas(self):
+        if not self.replicas:
+            return
+        started = time.monotonic()
+        try:
+            primary_lsn = parse_lsn(self._run(self.primary, "SELECT pg_current_wal_lsn()::text AS lsn", idempotent=True)[0]['lsn'])
+        except CircuitOpen:
+            return
+        except psycopg2.Error as e:
+            print(f"⚠️ Не удалось получить LSN основного сервера: {e}")
+            return
+        self._primary_lsns.append((started, primary_lsn))
+
+        for replica in self.replicas:
+            try:
+                row = self._run(replica, "SELECT pg_last_wal_replay_lsn()::text AS lsn", idempotent=True)[0]
+            except psycopg2.Error as e:
+                if replica.healthy:
+                    print(f"❌ Реплика {replica.name} недоступна: {e}")
+                replica.healthy = False
+                continue
+            # NULL - сервер не в режиме восстановления (не потоковая реплика)
+            replay_lsn = parse_lsn(row['lsn']) if row['lsn'] else primary_lsn
+            replica.lag_bytes = max(primary_lsn - replay_lsn, 0)
+            for sampled_at, lsn in reversed(self._primary_lsns):
+                if lsn <= replay_lsn:
+                    replica.caught_up_at = max(replica.caught_up_at, sampled_at)
+                    break
+            healthy = replica.lag_bytes <= DB_MAX_REPLICA_LAG_BYTES
+            if healthy != replica.healthy:
+                print(f"{'✅' if healthy else '⚠️'} Реплика {replica.name}: отставание {replica.lag_bytes} байт")
+            replica.healthy = healthy
+
+        # Чаты, чьи записи видны на всех репликах, больше не нужно отслеживать
+        oldest = min(r.caught_up_at for r in self.replicas)
+        for chat_id, written_at in list(self._last_write.items()):
+            if written_at <= oldest:
+                self._last_write.pop(chat_id, None)
+
+    def _after_write(self, chat_id: int, action: str, entity: str, rows: List[Dict]):
+        if self.changes:
+            self.changes.touch(entity)
+        if chat_id is not None and self.replicas:
+            self._last_write[chat_id] = time.monotonic()
+        if self.audit_log:
+            for row in rows:
+                before, after = row.get('before'), row.get('after')
+                entity_id = (after or before or {}).get('id')
+                self.audit_log.record(chat_id, action, entity, entity_id, before, after)
+        for listener in self.write_listeners:
+            try:
+                listener(chat_id, action, entity, rows)
+            except Exception as e:
+                print(f"❌ Write listener error: {e}")
     
-    def get_all_students(self) -> List[Dict]:
-        query = """
-        SELECT s.*, g.name as group_name 
+    # GET методы
+    @deadline(DB_TIMEOUT_LISTING_MS, DB_TIMEOUT_LOOKUP_MS)
+    @cached("student", "group")
+    def get_all_students(self, limit: int = None) -> List[Student]:
+        query = f"""
+        SELECT {Student.columns}
         FROM students s 
         LEFT JOIN groups g ON s.group_id = g.id
+        ORDER BY s.id
+        LIMIT %s
         """
-        return self.execute_query(query)
+        return self.execute_read(query, (limit,), row_type=Student)
     
-    def get_student_by_id(self, student_id: int) -> Dict:
-        query = """
-        SELECT s.*, g.name as group_name 
+    @deadline(DB_TIMEOUT_LISTING_MS, DB_TIMEOUT_LOOKUP_MS)
+    @cached("teacher", "department")
+    def get_all_teachers(self, limit: int = None) -> List[Teacher]:
+        query = f"""
+        SELECT {Teacher.columns}
+        FROM teachers t 
+        LEFT JOIN departments d ON t.department_id = d.id
+        ORDER BY t.id
+        LIMIT %s
+        """
+        return self.execute_read(query, (limit,), row_type=Teacher)
+    
+    @deadline(DB_TIMEOUT_LISTING_MS)
+    @cached("group")
+    def get_all_groups(self) -> List[Dict]:
+        query = "SELECT * FROM groups ORDER BY id"
+        return self.execute_read(query)
+    
+    @deadline(DB_TIMEOUT_LISTING_MS)
+    @cached("department")
+    def get_all_departments(self) -> List[Dict]:
+        query = "SELECT * FROM departments ORDER BY id"
+        return self.execute_read(query)
+    
+    @deadline(DB_TIMEOUT_LISTING_MS, DB_TIMEOUT_LOOKUP_MS)
+    @cached("subject")
+    def get_all_subjects(self, limit: int = None) -> List[Dict]:
+        query = "SELECT * FROM subjects ORDER BY id LIMIT %s"
+        return self.execute_read(query, (limit,))
+    
+    @deadline(DB_TIMEOUT_LISTING_MS, DB_TIMEOUT_LOOKUP_MS)
+    @cached("grade", "student", "subject", "teacher")
+    def get_all_grades(self, limit: int = None, date_from: date = None, date_to: date = None) -> List[Grade]:
+        query = f"""
+        SELECT {Grade.columns}
+        FROM grades g
+        JOIN students s ON g.student_id = s.id
+        JOIN subjects sub ON g.subject_id = sub.id
+        JOIN teachers t ON g.teacher_id = t.id
+        WHERE {EXAM_DATE_RANGE}
+        ORDER BY g.id
+        LIMIT %s
+        """
+        params = (date_from, date_from, date_to, date_to, limit)
+        return self.execute_read(query, params, row_type=Grade)
+    
+    # Пакетные методы: один запрос с = ANY(%s) вместо запроса на каждый ID
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_students_by_ids(self, student_ids: List[int]) -> Dict[int, Student]:
+        if not student_ids:
+            return {}
+        query = f"""
+        SELECT {Student.columns}
         FROM students s 
         LEFT JOIN groups g ON s.group_id = g.id 
-        WHERE s.id = %s
+        WHERE s.id = ANY(%s)
+        """
+        rows = self.execute_read(query, (list(student_ids),), row_type=Student)
+        return {row.id: row for row in rows}
+
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_teachers_by_ids(self, teacher_ids: List[int]) -> Dict[int, Teacher]:
+        if not teacher_ids:
+            return {}
+        query = f"""
+        SELECT {Teacher.columns}
+        FROM teachers t 
+        LEFT JOIN departments d ON t.department_id = d.id 
+        WHERE t.id = ANY(%s)
         """
-        result = self.execute_query(query, (student_id,))
-        return result[0] if result else {}
+        rows = self.execute_read(query, (list(teacher_ids),), row_type=Teacher)
+        return {row.id: row for row in rows}
+
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_grades_by_ids(self, grade_ids: List[int]) -> Dict[int, Grade]:
+        if not grade_ids:
+            return {}
+        query = f"""
+        SELECT {Grade.columns}
+        FROM grades g
+        JOIN students s ON g.student_id = s.id
+        JOIN subjects sub ON g.subject_id = sub.id
+        JOIN teachers t ON g.teacher_id = t.id
+        WHERE g.id = ANY(%s)
+        """
+        rows = self.execute_read(query, (list(grade_ids),), row_type=Grade)
+        return {row.id: row for row in rows}
+
+    @deadline(DB_TIMEOUT_LISTING_MS)
+    def get_grades_for_students(self, student_ids: List[int], date_from: date = None,
+                                date_to: date = None) -> Dict[int, List[Grade]]:
+        if not student_ids:
+            return {}
+        query = f"""
+        SELECT {Grade.columns}
+        FROM grades g
+        JOIN students s ON g.student_id = s.id
+        JOIN subjects sub ON g.subject_id = sub.id
+        JOIN teachers t ON g.teacher_id = t.id
+        WHERE g.student_id = ANY(%s) AND {EXAM_DATE_RANGE}
+        ORDER BY g.exam_date DESC, g.id
+        """
+        params = (list(student_ids), date_from, date_from, date_to, date_to)
+        grades = {student_id: [] for student_id in student_ids}
+        for row in self.execute_read(query, params, row_type=Grade):
+            grades[row.student_id].append(row)
+        return grades
+
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_subjects_by_ids(self, subject_ids: List[int]) -> Dict[int, Dict]:
+        if not subject_ids:
+            return {}
+        query = "SELECT * FROM subjects WHERE id = ANY(%s)"
+        rows = self.execute_read(query, (list(subject_ids),))
+        return {row['id']: row for row in rows}
+
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_groups_by_ids(self, group_ids: List[int]) -> Dict[int, Dict]:
+        if not group_ids:
+            return {}
+        query = "SELECT * FROM groups WHERE id = ANY(%s)"
+        rows = self.execute_read(query, (list(group_ids),))
+        return {row['id']: row for row in rows}
+
+    @deadline(DB_TIMEOUT_LISTING_MS)
+    def get_students_by_groups(self, group_ids: List[int]) -> Dict[int, List[Student]]:
+        if not group_ids:
+            return {}
+        query = f"""
+        SELECT {Student.columns}
+        FROM students s 
+        LEFT JOIN groups g ON s.group_id = g.id 
+        WHERE s.group_id = ANY(%s)
+        ORDER BY s.id
+        """
+        students = {group_id: [] for group_id in group_ids}
+        for row in self.execute_read(query, (list(group_ids),), row_type=Student):
+            students[row.group_id].append(row)
+        return students
+
+    # Одиночные методы - частный случай пакетных
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_student_by_id(self, student_id: int) -> Student:
+        return self.get_students_by_ids([student_id]).get(student_id, {})
     
-    def get_student_by_name(self, name: str) -> List[Dict]:
-        query = """
-        SELECT s.*, g.name as group_name 
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_teacher_by_id(self, teacher_id: int) -> Teacher:
+        return self.get_teachers_by_ids([teacher_id]).get(teacher_id, {})
+
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_grade_by_id(self, grade_id: int) -> Grade:
+        return self.get_grades_by_ids([grade_id]).get(grade_id, {})
+
+    @deadline(DB_TIMEOUT_LISTING_MS)
+    def get_student_grades(self, student_id: int, date_from: date = None, date_to: date = None) -> List[Grade]:
+        return self.get_grades_for_students([student_id], date_from, date_to)[student_id]
+
+    @deadline(DB_TIMEOUT_LISTING_MS)
+    def get_group_students(self, group_id: int) -> List[Student]:
+        return self.get_students_by_groups([group_id])[group_id]
+
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_student_by_name(self, name: str) -> List[Student]:
+        query = f"""
+        SELECT {Student.columns}
         FROM students s 
         LEFT JOIN groups g ON s.group_id = g.id 
         WHERE s.first_name ILIKE %s OR s.last_name ILIKE %s
         """
-        return self.execute_query(query, (f"%{name}%", f"%{name}%"))
-    
-    def get_all_teachers(self) -> List[Dict]:
+        return self.execute_read(query, (f"%{name}%", f"%{name}%"), row_type=Student)
+
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_teacher_subjects(self, teacher_id: int) -> List[Dict]:
         query = """
-        SELECT t.*, d.name as department_name 
-        FROM teachers t 
-        LEFT JOIN departments d ON t.department_id = d.id
+        SELECT DISTINCT s.name as subject_name, g.name as group_name
+        FROM teaching t
+        JOIN subjects s ON t.subject_id = s.id
+        JOIN groups g ON t.group_id = g.id
+        WHERE t.teacher_id = %s
+        """
+        return self.execute_read(query, (teacher_id,))
+
+    @deadline(DB_TIMEOUT_LOOKUP_MS)
+    def get_audit_log(self, entity: str, entity_id: int = None, limit: int = 10) -> List[Dict]:
+        query = """
+        SELECT * FROM audit_log
+        WHERE entity = %s AND (%s IS NULL OR entity_id = %s)
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
         """
+        # Журнал читается с основного сервера: его только что дописал flush()
+        return self.execute_query(query, (entity, entity_id, entity_id, limit))
+
+    # Подписки на уведомления об оценках (target_type: student | group)
+    @deadline(DB_TIMEOUT_LISTING_MS)
+    def get_all_subscriptions(self) -> List[Dict]:
+        query = "SELECT chat_id, target_type, target_id FROM subscriptions"
         return self.execute_query(query)
+
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def add_subscription(self, chat_id: int, target_type: str, target_id: int) -> bool:
+        query = """
+        INSERT INTO subscriptions (chat_id, target_type, target_id)
+        VALUES (%s, %s, %s)
+        ON CONFLICT DO NOTHING
+        RETURNING chat_id
+        """
+        try:
+            self.execute_write(query, (chat_id, target_type, target_id))
+            return True
+        except Exception as e:
+            print(f"❌ Error adding subscription: {e}")
+            return False
+
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def delete_subscription(self, chat_id: int, target_type: str = None, target_id: int = None) -> bool:
+        # Без цели удаляются все подписки чата
+        query = """
+        DELETE FROM subscriptions
+        WHERE chat_id = %s AND (%s IS NULL OR (target_type = %s AND target_id = %s))
+        """
+        try:
+            self.execute_write(query, (chat_id, target_type, target_type, target_id))
+            return True
+        except Exception as e:
+            print(f"❌ Error deleting subscription: {e}")
+            return False
+
+    # ADD методы
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def add_student(self, first_name: str, last_name: str, email: str, phone: str, group_id: int,
+                    chat_id: int = None) -> bool:
+        query = """
+        INSERT INTO students (first_name, last_name, email, phone, group_id, enrollment_date)
+        VALUES (%s, %s, %s, %s, %s, CURRENT_DATE)
+        RETURNING to_jsonb(students) AS after
+        """
+        try:
+            rows = self.execute_write(query, (first_name, last_name, email, phone, group_id))
+            self._after_write(chat_id, "add", "student", rows)
+            return True
+        except Exception as e:
+            print(f"❌ Error adding student: {e}")
+            return False
     
-    def get_teacher_by_id(self, teacher_id: int) -> Dict:
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def add_teacher(self, first_name: str, last_name: str, email: str, phone: str, department_id: int,
+                    chat_id: int = None) -> bool:
         query = """
-        SELECT t.*, d.name as department_name 
-        FROM teachers t 
-        LEFT JOIN departments d ON t.department_id = d.id 
-        WHERE t.id = %s
+        INSERT INTO teachers (first_name, last_name, email, phone, department_id, hire_date)
+        VALUES (%s, %s, %s, %s, %s, CURRENT_DATE)
+        RETURNING to_jsonb(teachers) AS after
         """
-        result = self.execute_query(query, (teacher_id,))
-        return result[0] if result else {}
+        try:
+            rows = self.execute_write(query, (first_name, last_name, email, phone, department_id))
+            self._after_write(chat_id, "add", "teacher", rows)
+            return True
+        except Exception as e:
+            print(f"❌ Error adding teacher: {e}")
+            return False
     
-    def get_student_grades(self, student_id: int) -> List[Dict]:
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def add_grade(self, student_id: int, subject_id: int, grade: int, teacher_id: int,
+                  chat_id: int = None) -> bool:
+        return self.add_grades([(student_id, subject_id, grade, teacher_id)], chat_id=chat_id)
+
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def add_grades(self, grades: List[tuple], chat_id: int = None) -> bool:
+        # grades: [(student_id, subject_id, grade, teacher_id), ...] - одним INSERT и одной транзакцией
+        if not grades:
+            return True
+        values = ", ".join(["(%s, %s, %s, %s, CURRENT_DATE)"] * len(grades))
+        query = f"""
+        INSERT INTO grades (student_id, subject_id, grade, teacher_id, exam_date)
+        VALUES {values}
+        RETURNING to_jsonb(grades) AS after
+        """
+        try:
+            rows = self.execute_write(query, tuple(value for grade in grades for value in grade))
+            self._after_write(chat_id, "add", "grade", rows)
+            return len(rows) == len(grades)
+        except Exception as e:
+            print(f"❌ Error adding grade: {e}")
+            return False
+
+    # UPDATE методы
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def update_student(self, student_id: int, first_name: str, last_name: str, email: str, phone: str, group_id: int,
+                       chat_id: int = None) -> bool:
+        # Подзапрос old отдает строку до изменения - аудит без лишнего SELECT
         query = """
-        SELECT g.grade, g.exam_date, s.name as subject_name, 
-               t.first_name || ' ' || t.last_name as teacher_name
-        FROM grades g
-        JOIN subjects s ON g.subject_id = s.id
-        JOIN teachers t ON g.teacher_id = t.id
-        WHERE g.student_id = %s
-        ORDER BY g.exam_date DESC
+        UPDATE students s
+        SET first_name = %s, last_name = %s, email = %s, phone = %s, group_id = %s
+        FROM (SELECT * FROM students WHERE id = %s FOR UPDATE) old
+        WHERE s.id = old.id
+        RETURNING to_jsonb(old) AS before, to_jsonb(s) AS after
         """
-        return self.execute_query(query, (student_id,))
+        try:
+            rows = self.execute_write(query, (first_name, last_name, email, phone, group_id, student_id))
+            self._after_write(chat_id, "update", "student", rows)
+            return True
+        except Exception as e:
+            print(f"❌ Error updating student: {e}")
+            return False
     
-    def get_group_students(self, group_id: int) -> List[Dict]:
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def update_teacher(self, teacher_id: int, first_name: str, last_name: str, email: str, phone: str, department_id: int,
+                       chat_id: int = None) -> bool:
         query = """
-        SELECT s.* 
-        FROM students s 
-        WHERE s.group_id = %s
+        UPDATE teachers t
+        SET first_name = %s, last_name = %s, email = %s, phone = %s, department_id = %s
+        FROM (SELECT * FROM teachers WHERE id = %s FOR UPDATE) old
+        WHERE t.id = old.id
+        RETURNING to_jsonb(old) AS before, to_jsonb(t) AS after
         """
-        return self.execute_query(query, (group_id,))
+        try:
+            rows = self.execute_write(query, (first_name, last_name, email, phone, department_id, teacher_id))
+            self._after_write(chat_id, "update", "teacher", rows)
+            return True
+        except Exception as e:
+            print(f"❌ Error updating teacher: {e}")
+            return False
     
-    def get_teacher_subjects(self, teacher_id: int) -> List[Dict]:
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def update_grade(self, grade_id: int, grade: int, chat_id: int = None) -> bool:
         query = """
-        SELECT DISTINCT s.name as subject_name, g.name as group_name
-        FROM teaching t
-        JOIN subjects s ON t.subject_id = s.id
-        JOIN groups g ON t.group_id = g.id
-        WHERE t.teacher_id = %s
+        UPDATE grades g
+        SET grade = %s
+        FROM (SELECT * FROM grades WHERE id = %s FOR UPDATE) old
+        WHERE g.id = old.id
+        RETURNING to_jsonb(old) AS before, to_jsonb(g) AS after
         """
-        return self.execute_query(query, (teacher_id,))
+        try:
+            rows = self.execute_write(query, (grade, grade_id))
+            self._after_write(chat_id, "update", "grade", rows)
+            return True
+        except Exception as e:
+            print(f"❌ Error updating grade: {e}")
+            return False
+
+    # DELETE методы
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def delete_student(self, student_id: int, chat_id: int = None) -> bool:
+        query = "DELETE FROM students WHERE id = %s RETURNING to_jsonb(students) AS before"
+        try:
+            rows = self.execute_write(query, (student_id,))
+            self._after_write(chat_id, "delete", "student", rows)
+            return True
+        except Exception as e:
+            print(f"❌ Error deleting student: {e}")
+            return False
+    
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def delete_teacher(self, teacher_id: int, chat_id: int = None) -> bool:
+        query = "DELETE FROM teachers WHERE id = %s RETURNING to_jsonb(teachers) AS before"
+        try:
+            rows = self.execute_write(query, (teacher_id,))
+            self._after_write(chat_id, "delete", "teacher", rows)
+            return True
+        except Exception as e:
+            print(f"❌ Error deleting teacher: {e}")
+            return False
+    
+    @deadline(DB_TIMEOUT_WRITE_MS)
+    def delete_grade(self, grade_id: int, chat_id: int = None) -> bool:
+        query = "DELETE FROM grades WHERE id = %s RETURNING to_jsonb(grades) AS before"
+        try:
+            rows = self.execute_write(query, (grade_id,))
+            self._after_write(chat_id, "delete", "grade", rows)
+            return True
+        except Exception as e:
+            print(f"❌ Error deleting grade: {e}")
+            return False
 
     def close(self):
-        if self.connection:
-            self.connection.close()
\ No newline at end of file
+        self._stop.set()
+        if self.changes:
+            self.changes.stop()
+        if self.batcher:
+            self.batcher.close()
+        self.primary.close()
+        for replica in self.replicas:
+            replica.close()
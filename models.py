@@ -0,0 +1,63 @@
+from typing import Any, Dict, Iterator
+
+# Компактные строки результатов: значения хранятся в __slots__ без словаря
+# на каждую строку, но доступ как к dict (row['id'], row.get(...)) сохранен
+
+
+class Row:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__
+
+    def keys(self):
+        return self.__slots__
+
+    def items(self) -> Iterator:
+        return ((name, getattr(self, name)) for name in self.__slots__)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and all(getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+
+# Порядок полей совпадает с порядком колонок в SELECT
+class Student(Row):
+    __slots__ = ('id', 'first_name', 'last_name', 'email', 'phone', 'group_id',
+                 'enrollment_date', 'group_name')
+    columns = ("s.id, s.first_name, s.last_name, s.email, s.phone, s.group_id, "
+               "s.enrollment_date, g.name AS group_name")
+
+
+class Teacher(Row):
+    __slots__ = ('id', 'first_name', 'last_name', 'email', 'phone', 'department_id',
+                 'hire_date', 'department_name')
+    columns = ("t.id, t.first_name, t.last_name, t.email, t.phone, t.department_id, "
+               "t.hire_date, d.name AS department_name")
+
+
+class Grade(Row):
+    __slots__ = ('id', 'student_id', 'subject_id', 'grade', 'exam_date', 'teacher_id',
+                 'student_first_name', 'student_last_name', 'subject_name',
+                 'teacher_first_name', 'teacher_last_name')
+    columns = ("g.id, g.student_id, g.subject_id, g.grade, g.exam_date, g.teacher_id, "
+               "s.first_name AS student_first_name, s.last_name AS student_last_name, "
+               "sub.name AS subject_name, t.first_name AS teacher_first_name, t.last_name AS teacher_last_name")
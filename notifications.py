@@ -0,0 +1,198 @@
+import queue
+import threading
+import time
+from typing import List, Dict, Set, Tuple
+
+from telebot.apihelper import ApiTelegramException
+
+# Telegram: не больше ~30 сообщений в секунду всего и ~1 в секунду в один чат
+MAX_MESSAGE_LENGTH = 4000
+
+
+# Уведомления об оценках: изменения копятся в очереди, раз в окно собираются
+# в одну сводку на получателя и отправляются с учетом лимитов Telegram
+class GradeNotifier:
+    def __init__(self, bot, db, window: float = 2.0, global_rate: float = 25.0,
+                 chat_interval: float = 1.0, max_queue: int = 10000):
+        self.bot = bot
+        self.db = db
+        self.window = window
+        self.send_interval = 1.0 / global_rate
+        self.chat_interval = chat_interval
+        self.events = queue.Queue(maxsize=max_queue)
+        # (target_type, target_id) -> чаты-подписчики
+        self.subscribers: Dict[Tuple[str, int], Set[int]] = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+        # Не отправленные из-за лимита сводки: chat_id -> строки
+        self._pending: Dict[int, List[str]] = {}
+        self._backlog: List[tuple] = []
+        self._last_sent: Dict[int, float] = {}
+        self._last_send = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="grade-notifier", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def load(self) -> bool:
+        try:
+            rows = self.db.get_all_subscriptions()
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить подписки: {e}")
+            return False
+        subscribers: Dict[Tuple[str, int], Set[int]] = {}
+        for row in rows:
+            subscribers.setdefault((row['target_type'], row['target_id']), set()).add(row['chat_id'])
+        with self.lock:
+            self.subscribers = subscribers
+        self.loaded = True
+        return True
+
+    # Подключается к ChangeListener.callbacks: подписки, измененные другим экземпляром бота,
+    # перечитываются на следующем цикле
+    def on_change(self, entity: str, entity_id: int, op: str):
+        if entity in (None, "subscription"):
+            self.loaded = False
+
+    def subscribe(self, chat_id: int, target_type: str, target_id: int) -> bool:
+        if not self.db.add_subscription(chat_id, target_type, target_id):
+            return False
+        with self.lock:
+            self.subscribers.setdefault((target_type, target_id), set()).add(chat_id)
+        return True
+
+    def unsubscribe(self, chat_id: int, target_type: str = None, target_id: int = None) -> bool:
+        if not self.db.delete_subscription(chat_id, target_type, target_id):
+            return False
+        with self.lock:
+            for key, chats in self.subscribers.items():
+                if target_type is None or key == (target_type, target_id):
+                    chats.discard(chat_id)
+        return True
+
+    def chat_subscriptions(self, chat_id: int) -> List[Tuple[str, int]]:
+        with self.lock:
+            return sorted(key for key, chats in self.subscribers.items() if chat_id in chats)
+
+    # Подключается к CollegeDatabase.write_listeners
+    def on_write(self, chat_id: int, action: str, entity: str, rows: List[Dict]):
+        if entity != "grade" or action not in ("add", "update"):
+            return
+        for row in rows:
+            before, after = row.get('before'), row['after']
+            if before and before['grade'] == after['grade']:
+                continue
+            try:
+                self.events.put_nowait((chat_id, action, before, after))
+            except queue.Full:
+                print("⚠️ Очередь уведомлений переполнена, событие отброшено")
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.loaded and not self.load():
+                self._stop.wait(self.window)
+                continue
+            events = self._collect()
+            if events:
+                try:
+                    self._build_digests(events)
+                except Exception as e:
+                    # БД недоступна - попробуем собрать сводки в следующий раз
+                    print(f"⚠️ Не удалось подготовить уведомления: {e}")
+                    self._backlog = events
+            self._send_pending()
+
+    def _collect(self) -> List[tuple]:
+        events, self._backlog = self._backlog, []
+        # Пока есть неотправленные сводки, не ждем новых событий слишком долго
+        timeout = self.chat_interval if self._pending or events else self.window
+        try:
+            events.append(self.events.get(timeout=timeout))
+        except queue.Empty:
+            return events
+        deadline = time.monotonic() + self.window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                events.append(self.events.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return events
+
+    def _build_digests(self, events: List[tuple]):
+        with self.lock:
+            if not any(self.subscribers.values()):
+                return
+        # Все имена одним пакетом запросов на окно, а не на каждую оценку
+        students = self.db.get_students_by_ids({after['student_id'] for _, _, _, after in events})
+        subjects = self.db.get_subjects_by_ids({after['subject_id'] for _, _, _, after in events})
+
+        with self.lock:
+            for author, action, before, after in events:
+                student = students.get(after['student_id'])
+                if not student:
+                    continue
+                recipients = set(self.subscribers.get(("student", student.id), ()))
+                recipients |= self.subscribers.get(("group", student.group_id), set())
+                recipients.discard(author)
+                if not recipients:
+                    continue
+
+                subject = subjects.get(after['subject_id'], {})
+                line = f"{student.first_name} {student.last_name}"
+                if student.group_name:
+                    line += f" ({student.group_name})"
+                line += f"\n   📖 {subject.get('name', after['subject_id'])}: {after['grade']}"
+                if action == "update" and before:
+                    line = "✏️ " + line + f" (было {before['grade']})"
+                else:
+                    line = "📝 " + line
+                for chat_id in recipients:
+                    self._pending.setdefault(chat_id, []).append(line)
+
+    def _send_pending(self):
+        for chat_id in list(self._pending):
+            if self._stop.is_set():
+                return
+            if time.monotonic() - self._last_sent.get(chat_id, 0.0) < self.chat_interval:
+                continue
+            # Глобальный лимит: равномерно разносим отправки
+            wait = self._last_send + self.send_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            lines = self._pending.pop(chat_id)
+            text, rest = "🔔 НОВЫЕ ОЦЕНКИ:\n\n", []
+            for i, line in enumerate(lines):
+                if i and len(text) + len(line) > MAX_MESSAGE_LENGTH:
+                    rest = lines[i:]
+                    break
+                text += line + "\n"
+            try:
+                self.bot.send_message(chat_id, text)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
+                    self._pending[chat_id] = lines
+                    self._stop.wait(retry_after)
+                    return
+                if e.error_code == 403:
+                    # Бот заблокирован - подписки этого чата больше не нужны
+                    self.unsubscribe(chat_id)
+                    continue
+                print(f"❌ Ошибка отправки уведомления в {chat_id}: {e}")
+            except Exception as e:
+                print(f"❌ Ошибка отправки уведомления в {chat_id}: {e}")
+                self._pending[chat_id] = lines
+                return
+            finally:
+                self._last_send = time.monotonic()
+                self._last_sent[chat_id] = self._last_send
+            if rest:
+                self._pending[chat_id] = rest
@@ -0,0 +1,161 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter as Tally
+from typing import Callable, Dict, Optional, Tuple
+
+# Профилирование по запросу администратора: семплер стеков всех потоков
+# и/или tracemalloc на N секунд. Пока профиль не запущен, ничего не выполняется
+
+
+def frame_label(code) -> str:
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def thread_cpu_time(ident: int) -> Optional[float]:
+    # Процессорное время потока (только Unix); None - меряем только по стенным часам
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class Profiler:
+    def __init__(self, handler_file: str, handler_thread_prefix: str = "handler",
+                 interval: float = 0.005, top: int = 25):
+        # Обработчик - самая внешняя функция из handler_file в потоке пула обработчиков
+        self.handler_file = handler_file
+        self.handler_thread_prefix = handler_thread_prefix
+        self.interval = interval
+        self.top = top
+        self.lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.lock.locked()
+
+    # Запускает профиль в отдельном потоке; on_done(report) вызывается по окончании.
+    # False - если профиль уже идет
+    def start(self, seconds: float, cpu: bool, memory: bool, on_done: Callable[[str], None]) -> bool:
+        if not self.lock.acquire(blocking=False):
+            return False
+
+        def run():
+            try:
+                report = self.profile(seconds, cpu, memory)
+            except Exception as e:
+                report = f"Ошибка профилирования: {e}"
+            finally:
+                self.lock.release()
+            on_done(report)
+
+        threading.Thread(target=run, name="profiler", daemon=True).start()
+        return True
+
+    def profile(self, seconds: float, cpu: bool, memory: bool) -> str:
+        started_tracing = memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(10)
+        try:
+            started = time.time()
+            if cpu:
+                samples = self._sample(seconds)
+            else:
+                samples = None
+                time.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot() if memory else None
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+
+        lines = [f"Профиль процесса {os.getpid()}: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started))}, "
+                 f"{seconds:g} сек"]
+        if samples:
+            lines += self._render_samples(*samples)
+        if snapshot:
+            lines += self._render_snapshot(snapshot)
+        return "\n".join(lines) + "\n"
+
+    def _sample(self, seconds: float) -> Tuple:
+        own = threading.get_ident()
+        wall, cpu = Tally(), Tally()
+        handlers: Dict[str, Tally] = {}
+        cpu_times: Dict[int, float] = {}
+        ticks = 0
+        started = time.monotonic()
+        deadline = started + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                # Поток считается на процессоре, если его CPU-время выросло с прошлого тика
+                now_cpu = thread_cpu_time(ident)
+                on_cpu = now_cpu is None or now_cpu > cpu_times.get(ident, now_cpu)
+                if now_cpu is not None:
+                    cpu_times[ident] = now_cpu
+
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                top = frame_label(stack[0])
+                wall[top] += 1
+                if on_cpu:
+                    cpu[top] += 1
+
+                if names.get(ident, "").startswith(self.handler_thread_prefix):
+                    handler = next((code for code in reversed(stack) if code.co_filename == self.handler_file), None)
+                    if handler is not None:
+                        stats = handlers.setdefault(handler.co_qualname, Tally())
+                        stats["wall"] += 1
+                        stats["cpu"] += on_cpu
+                        stats["db"] += any(code.co_filename.endswith("database.py") for code in stack)
+            ticks += 1
+            time.sleep(self.interval)
+        # Тик длиннее interval на время самого обхода стеков - считаем по факту
+        step = (time.monotonic() - started) / max(ticks, 1)
+        return ticks, step, wall, cpu, handlers
+
+    def _render_samples(self, ticks: int, step: float, wall: Tally, cpu: Tally, handlers: Dict[str, Tally]) -> list:
+        lines = ["", f"=== Семплы стеков: {ticks} тиков по ~{step * 1000:.1f} мс ===",
+                 "", "Топ функций на процессоре (собственное время):"]
+        total_cpu = sum(cpu.values()) or 1
+        for label, count in cpu.most_common(self.top):
+            lines.append(f"  {count * step:8.3f} с  {count * 100 / total_cpu:5.1f}%  {label}")
+
+        lines += ["", "Топ функций по стенному времени (включая ожидание):"]
+        for label, count in wall.most_common(self.top):
+            lines.append(f"  {count * step:8.3f} с  {label}")
+
+        lines += ["", "Обработчики (стенное время / на процессоре / в запросах к БД):"]
+        if not handlers:
+            lines.append("  за время профиля обработчики не выполнялись")
+        for name, stats in sorted(handlers.items(), key=lambda item: -item[1]["wall"]):
+            lines.append(f"  {stats['wall'] * step:8.3f} с  {stats['cpu'] * step:8.3f} с  "
+                         f"{stats['db'] * step:8.3f} с  {name}")
+        return lines
+
+    def _render_snapshot(self, snapshot: tracemalloc.Snapshot) -> list:
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+        stats = snapshot.statistics("lineno")
+        total = sum(stat.size for stat in stats)
+        lines = ["", f"=== tracemalloc: живых выделений за время профиля {total / 1024:.1f} КиБ ===",
+                 "", "Топ мест выделения памяти:"]
+        for stat in stats[:self.top]:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size / 1024:10.1f} КиБ  {stat.count:8d} блоков  "
+                         f"{os.path.basename(frame.filename)}:{frame.lineno}")
+
+        lines += ["", "Топ стеков выделения:"]
+        for stat in snapshot.statistics("traceback")[:5]:
+            lines.append(f"  {stat.size / 1024:.1f} КиБ, {stat.count} блоков")
+            lines += [f"    {line}" for line in stat.traceback.format(limit=6)]
+        return lines
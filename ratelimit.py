@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from metrics import Counter, Gauge
+
+RATE_LIMIT_REQUESTS = Counter("college_bot_ratelimit_requests_total",
+                              "Входящие сообщения по маршрутам: allowed, throttled_chat, throttled_global")
+RATE_LIMIT_SHED_REPLIES = Counter("college_bot_ratelimit_shed_replies_total",
+                                  "Ответы на отброшенные сообщения: cached или notice")
+RATE_LIMIT_GLOBAL_TOKENS = Gauge("college_bot_ratelimit_global_tokens", "Свободные токены общего лимита")
+RATE_LIMIT_CHATS = Gauge("college_bot_ratelimit_tracked_chats", "Число чатов с собственным лимитом")
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'noticed_at')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        # Когда чату последний раз отвечали на отброшенное сообщение
+        self.noticed_at = float("-inf")
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait_time(self, cost: float) -> float:
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+# Лимит входящих сообщений: у каждого чата своя "корзина" токенов и одна общая на весь бот.
+# Сообщение проходит, только если стоимость маршрута есть в обеих корзинах
+class RateLimiter:
+    def __init__(self, chat_rate: float, chat_burst: float, global_rate: float, global_burst: float,
+                 costs: Dict[str, float], max_chats: int = 10000):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.costs = costs
+        self.max_chats = max_chats
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(global_rate, global_burst, time.monotonic())
+        # Давно не писавшие чаты вытесняются: их корзина все равно была бы полной
+        self.chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def cost(self, route: str) -> float:
+        return self.costs.get(route, 1.0)
+
+    # Возвращает (None, 0) если можно обрабатывать, иначе ("chat" | "global", сколько ждать в секундах)
+    def acquire(self, chat_id: int, route: str) -> Tuple[Optional[str], float]:
+        cost = self.cost(route)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.chats.get(chat_id)
+            if bucket is None:
+                bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+                if len(self.chats) > self.max_chats:
+                    self.chats.popitem(last=False)
+            else:
+                self.chats.move_to_end(chat_id)
+            bucket.refill(now)
+            self.global_bucket.refill(now)
+
+            if bucket.tokens < cost:
+                reason, wait = "chat", bucket.wait_time(cost)
+            elif self.global_bucket.tokens < cost:
+                reason, wait = "global", self.global_bucket.wait_time(cost)
+            else:
+                bucket.tokens -= cost
+                self.global_bucket.tokens -= cost
+                reason, wait = None, 0.0
+            global_tokens, chats = self.global_bucket.tokens, len(self.chats)
+
+        RATE_LIMIT_REQUESTS.inc(route=route, result=f"throttled_{reason}" if reason else "allowed")
+        RATE_LIMIT_GLOBAL_TOKENS.set(round(global_tokens, 2))
+        RATE_LIMIT_CHATS.set(chats)
+        return reason, wait
+
+    # Ответ на отброшенное сообщение - не чаще раза в interval на чат
+    def claim_notice(self, chat_id: int, interval: float) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.chats.get(chat_id)
+            if bucket is None or now - bucket.noticed_at < interval:
+                return False
+            bucket.noticed_at = now
+            return True
+
+
+# Последние готовые ответы на тяжелые запросы (списки, статистика) -
+# ими отвечаем на отброшенные сообщения, не обращаясь к БД
+class ReplyCache:
+    def __init__(self):
+        self.replies: Dict[str, Tuple[float, str]] = {}
+        self.lock = threading.Lock()
+
+    def store(self, key: str, text: str):
+        with self.lock:
+            self.replies[key] = (time.time(), text)
+
+    def get(self, key: str) -> Optional[Tuple[float, str]]:
+        with self.lock:
+            return self.replies.get(key)
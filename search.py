@@ -0,0 +1,245 @@
+import queue
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
+
+# Поиск по началу имени для inline-режима: отсортированные массивы ключей в памяти процесса.
+# Ключ - каждое слово имени, поэтому "пет" находит и "Петр Иванов", и "Иван Петров"
+
+Ref = Tuple[str, int]  # (вид, ID): ("student", 12)
+
+KINDS = ("student", "teacher", "subject")
+
+# Сколько секунд ждем уведомление о собственной записи, уже примененной в on_write
+OWN_WRITE_TTL = 10.0
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+class PrefixIndex:
+    def __init__(self):
+        self.keys: List[str] = []
+        self.refs: List[Ref] = []
+        # (вид, ID) -> (имя, пояснение)
+        self.labels: Dict[Ref, Tuple[str, str]] = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def put(self, kind: str, entity_id: int, name: str, description: str = ""):
+        ref = (kind, entity_id)
+        with self.lock:
+            self._remove(ref)
+            self.labels[ref] = (name, description)
+            for word in set(normalize(name).split()):
+                position = bisect_right(self.keys, word)
+                self.keys.insert(position, word)
+                self.refs.insert(position, ref)
+
+    def remove(self, kind: str, entity_id: int):
+        with self.lock:
+            self._remove((kind, entity_id))
+
+    def _remove(self, ref: Ref):
+        label = self.labels.pop(ref, None)
+        if not label:
+            return
+        for word in set(normalize(label[0]).split()):
+            position = bisect_left(self.keys, word)
+            while position < len(self.keys) and self.keys[position] == word:
+                if self.refs[position] == ref:
+                    del self.keys[position]
+                    del self.refs[position]
+                    break
+                position += 1
+
+    def replace(self, entries: List[Tuple[str, int, str, str]]):
+        # Полная перезагрузка: новый индекс строится целиком и подменяется одним присваиванием
+        pairs, labels = [], {}
+        for kind, entity_id, name, description in entries:
+            labels[(kind, entity_id)] = (name, description)
+            pairs += [(word, (kind, entity_id)) for word in set(normalize(name).split())]
+        pairs.sort()
+        with self.lock:
+            self.keys = [word for word, _ in pairs]
+            self.refs = [ref for _, ref in pairs]
+            self.labels = labels
+            self.loaded = True
+
+    def search(self, query: str, kind: Optional[str] = None, limit: int = 20) -> List[Tuple[str, int, str, str]]:
+        words = normalize(query).split()
+        if not words:
+            return []
+        # Самое длинное слово запроса дает самый короткий диапазон кандидатов,
+        # остальные слова проверяются по имени кандидата
+        first = max(words, key=len)
+        rest = [word for word in words if word is not first]
+        results, seen = [], set()
+        with self.lock:
+            position = bisect_left(self.keys, first)
+            while position < len(self.keys) and self.keys[position].startswith(first):
+                ref = self.refs[position]
+                position += 1
+                if ref in seen or (kind and ref[0] != kind):
+                    continue
+                seen.add(ref)
+                name, description = self.labels[ref]
+                name_words = normalize(name).split()
+                if all(any(w.startswith(word) for w in name_words) for word in rest):
+                    results.append((ref[0], ref[1], name, description))
+                    if len(results) >= limit:
+                        break
+        return results
+
+
+# Держит индекс в актуальном состоянии: загрузка при старте, свои записи через
+# CollegeDatabase.write_listeners, чужие - через уведомления ChangeListener.
+# Чтения из БД по уведомлениям выполняет свой поток, а не поток ChangeListener
+class NameIndex:
+    def __init__(self, db):
+        self.db = db
+        self.index = PrefixIndex()
+        self.group_names: Dict[int, str] = {}
+        self.department_names: Dict[int, str] = {}
+        # (вид, ID) -> когда применили свою запись: уведомление о ней перечитывать не нужно
+        self.own_writes: Dict[Ref, List[float]] = {}
+        self.lock = threading.Lock()
+        # Изменения, которые нужно перечитать: (сущность, ID, операция); сущность None - перестроить все
+        self.pending: "queue.Queue[Tuple[Optional[str], Optional[int], Optional[str]]]" = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="name-index", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def search(self, query: str, kind: Optional[str] = None, limit: int = 20):
+        return self.index.search(query, kind, limit)
+
+    def load(self) -> bool:
+        try:
+            with self.db.primary_reads():
+                self.group_names = {g['id']: g['name'] for g in self.db.get_all_groups()}
+                self.department_names = {d['id']: d['name'] for d in self.db.get_all_departments()}
+                entries = [self._student_entry(s) for s in self.db.get_all_students()]
+                entries += [self._teacher_entry(t) for t in self.db.get_all_teachers()]
+                entries += [self._subject_entry(s) for s in self.db.get_all_subjects()]
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить индекс имен: {e}")
+            return False
+        self.index.replace(entries)
+        print(f"🔎 Индекс имен загружен: {len(self.index)} записей")
+        return True
+
+    def _student_entry(self, row) -> Tuple[str, int, str, str]:
+        group = self.group_names.get(row['group_id'])
+        return ("student", row['id'], f"{row['first_name']} {row['last_name']}",
+                f"Студент, группа {group}" if group else "Студент")
+
+    def _teacher_entry(self, row) -> Tuple[str, int, str, str]:
+        department = self.department_names.get(row['department_id'])
+        return ("teacher", row['id'], f"{row['first_name']} {row['last_name']}",
+                f"Преподаватель, {department}" if department else "Преподаватель")
+
+    def _subject_entry(self, row) -> Tuple[str, int, str, str]:
+        return ("subject", row['id'], row['name'], "Предмет")
+
+    def _apply(self, kind: str, entity_id: int, row):
+        if row is None:
+            self.index.remove(kind, entity_id)
+        elif kind == "student":
+            self.index.put(*self._student_entry(row))
+        elif kind == "teacher":
+            self.index.put(*self._teacher_entry(row))
+        else:
+            self.index.put(*self._subject_entry(row))
+
+    # Подключается к CollegeDatabase.write_listeners: строки after/before уже есть, БД не нужна
+    def on_write(self, chat_id: int, action: str, entity: str, rows: List[Dict]):
+        if entity not in KINDS:
+            return
+        # Уведомления придут, только если подписка активна
+        track = self.db.changes is not None and self.db.changes.connected.is_set()
+        now = time.monotonic()
+        for row in rows:
+            after, before = row.get('after'), row.get('before')
+            entity_id = (after or before)['id']
+            self._apply(entity, entity_id, after)
+            if track:
+                with self.lock:
+                    self.own_writes.setdefault((entity, entity_id), []).append(now)
+        if track:
+            with self.lock:
+                self.own_writes = {ref: times for ref, times in self.own_writes.items()
+                                   if now - times[-1] < OWN_WRITE_TTL}
+
+    # Уведомление о записи, которую этот экземпляр уже применил в on_write.
+    # Отметка устаревает через OWN_WRITE_TTL: если уведомление обогнало on_write, она
+    # не должна скрыть следующее, уже чужое изменение той же строки
+    def _own_write(self, ref: Ref) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            times = [t for t in self.own_writes.pop(ref, []) if now - t < OWN_WRITE_TTL]
+            if len(times) > 1:
+                self.own_writes[ref] = times[1:]
+            return bool(times)
+
+    # Подключается к ChangeListener.callbacks и вызывается в его потоке, поэтому только ставит
+    # изменение в очередь. Уведомления приходят обо всех записях, в том числе своих:
+    # свои уже применены в on_write, чужие перечитываем по ID
+    def on_change(self, entity: Optional[str], entity_id: Optional[int], op: Optional[str]):
+        if entity is None:
+            with self.lock:
+                self.own_writes.clear()
+            # Подключение до первой загрузки: загрузка при старте и так прочитает все
+            if not self.index.loaded:
+                return
+        elif entity not in ("group", "department"):
+            if entity not in KINDS or entity_id is None or self._own_write((entity, entity_id)):
+                return
+        self.pending.put((entity, entity_id, op))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                changes = [self.pending.get(timeout=1.0)]
+            except queue.Empty:
+                continue
+            # Накопившиеся за время чтения изменения разбираем одной пачкой
+            while True:
+                try:
+                    changes.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            if any(entity is None or entity in ("group", "department") for entity, _, _ in changes):
+                # Потеряны уведомления или сменились названия групп/отделов - перестраиваем целиком
+                self.load()
+            else:
+                self._refresh(changes)
+
+    def _refresh(self, changes: List[Tuple[str, int, Optional[str]]]):
+        # вид -> ID -> последняя операция
+        latest: Dict[str, Dict[int, Optional[str]]] = {}
+        for entity, entity_id, op in changes:
+            latest.setdefault(entity, {})[entity_id] = op
+        lookups = {"student": self.db.get_students_by_ids, "teacher": self.db.get_teachers_by_ids,
+                   "subject": self.db.get_subjects_by_ids}
+        for kind, ops in latest.items():
+            changed = [entity_id for entity_id, op in ops.items() if op != "delete"]
+            rows = {}
+            if changed:
+                try:
+                    with self.db.primary_reads():
+                        rows = lookups[kind](changed)
+                except Exception as e:
+                    print(f"⚠️ Не удалось обновить индекс имен: {e}")
+                    continue
+            for entity_id in ops:
+                self._apply(kind, entity_id, rows.get(entity_id))
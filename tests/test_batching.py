@@ -0,0 +1,152 @@
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+
+import psycopg2.errors
+
+from batching import WriteBatcher
+
+# Групповой коммит на поддельном соединении: проверяется, какие команды уходят в БД,
+# без сервера PostgreSQL. Запрос "FAIL" завершается нарушением ограничения, "DEADLOCK" - взаимоблокировкой,
+# "DISCONNECT" - обрывом соединения, "SLOW" выполняется 0.3 с
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = self.connection = conn
+        self.description = None
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=()):
+        self.conn.log.append(query)
+        self.description = None
+        if "FAIL" in query:
+            raise psycopg2.errors.UniqueViolation("duplicate key")
+        if "DEADLOCK" in query:
+            raise psycopg2.errors.DeadlockDetected("deadlock detected")
+        if "DISCONNECT" in query:
+            self.conn.closed = True
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        if "SLOW" in query:
+            time.sleep(0.3)
+        if "RETURNING" in query:
+            self.description = [("id",)]
+            self.result = [{"id": params[0]}]
+
+    def fetchall(self):
+        return self.result
+
+
+class FakeConnection:
+    def __init__(self, log):
+        self.log = log
+        self.closed = False
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.log.append("COMMIT")
+
+    def rollback(self):
+        self.log.append("ROLLBACK")
+
+
+class FakeNode:
+    def __init__(self):
+        self.log = []
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self.log)
+
+
+class WriteBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.node = FakeNode()
+        self.batcher = WriteBatcher(self.node, window_ms=100, max_batch=64)
+
+    def tearDown(self):
+        self.batcher.close()
+
+    def submit_all(self, queries, timeout_ms=None):
+        results = [None] * len(queries)
+
+        def submit(i, query):
+            try:
+                results[i] = self.batcher.submit(query, (i,), timeout_ms)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=submit, args=(i, q)) for i, q in enumerate(queries)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_one_commit_per_batch(self):
+        results = self.submit_all(["INSERT INTO t VALUES (%s) RETURNING id"] * 10)
+        self.assertEqual(self.node.log.count("COMMIT"), 1)
+        self.assertEqual(results, [[{"id": i}] for i in range(10)])
+        writes = [q for q in self.node.log if q.startswith("SAVEPOINT")]
+        self.assertEqual(len(writes), 10)
+        self.assertEqual(self.node.log.count("RELEASE SAVEPOINT batch_write"), 10)
+
+    def test_only_failing_write_rolled_back(self):
+        queries = ["INSERT INTO t VALUES (%s) RETURNING id"] * 5
+        queries[2] = "INSERT FAIL"
+        results = self.submit_all(queries)
+        self.assertIsInstance(results[2], psycopg2.errors.UniqueViolation)
+        for i in (0, 1, 3, 4):
+            self.assertEqual(results[i], [{"id": i}])
+        self.assertEqual(self.node.log.count("ROLLBACK TO SAVEPOINT batch_write; RELEASE SAVEPOINT batch_write"), 1)
+        self.assertEqual(self.node.log.count("RELEASE SAVEPOINT batch_write"), 4)
+        self.assertEqual(self.node.log.count("COMMIT"), 1)
+        self.assertNotIn("ROLLBACK", self.node.log)
+
+    def test_server_error_on_live_connection_fails_only_that_write(self):
+        queries = ["INSERT INTO t VALUES (%s) RETURNING id"] * 5
+        queries[1] = "UPDATE DEADLOCK"
+        results = self.submit_all(queries)
+        self.assertIsInstance(results[1], psycopg2.errors.DeadlockDetected)
+        for i in (0, 2, 3, 4):
+            self.assertEqual(results[i], [{"id": i}])
+        self.assertEqual(self.node.log.count("ROLLBACK TO SAVEPOINT batch_write; RELEASE SAVEPOINT batch_write"), 1)
+        self.assertEqual(self.node.log.count("COMMIT"), 1)
+
+    def test_broken_connection_fails_whole_batch(self):
+        queries = ["INSERT INTO t VALUES (%s) RETURNING id"] * 3
+        queries[1] = "UPDATE DISCONNECT"
+        results = self.submit_all(queries)
+        for result in results:
+            self.assertIsInstance(result, psycopg2.OperationalError)
+        self.assertNotIn("COMMIT", self.node.log)
+
+    def test_statement_timeout_per_write(self):
+        self.submit_all(["INSERT INTO t VALUES (%s)"], timeout_ms=2000)
+        write = next(q for q in self.node.log if q.startswith("SAVEPOINT"))
+        timeout = int(write.split("statement_timeout = ")[1].split(";")[0])
+        self.assertTrue(0 < timeout <= 2000)
+
+    def test_timed_out_write_is_not_applied(self):
+        # Первая запись задерживает пачку дольше, чем готова ждать вторая
+        slow = threading.Thread(target=self.batcher.submit, args=("UPDATE SLOW",))
+        slow.start()
+        time.sleep(0.02)
+        with self.assertRaises(TimeoutError):
+            self.batcher.submit("INSERT INTO t VALUES (%s)", (1,), timeout_ms=150)
+        slow.join()
+        time.sleep(0.05)
+        self.assertFalse([q for q in self.node.log if "INSERT" in q])
+
+
+if __name__ == "__main__":
+    unittest.main()
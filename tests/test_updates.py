@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+from updates import UpdateCheckpoint, UpdatePoller
+
+# Позиция обновлений на диске: ее хватает, чтобы после перезапуска не потерять и не повторить обновления
+
+
+class UpdateCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "update_offset.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_offset_waits_for_earliest_in_flight(self):
+        checkpoint = UpdateCheckpoint(self.path)
+        for update_id in (1, 2, 3):
+            checkpoint.begin(update_id)
+        checkpoint.finish(3)
+        checkpoint.finish(2)
+        self.assertEqual(checkpoint.offset, 0)
+        self.assertEqual(checkpoint.done, {2, 3})
+        checkpoint.finish(1)
+        self.assertEqual(checkpoint.offset, 3)
+        self.assertEqual(checkpoint.done, set())
+
+    def test_reload_from_disk(self):
+        checkpoint = UpdateCheckpoint(self.path)
+        for update_id in (5, 6, 7):
+            checkpoint.begin(update_id)
+        checkpoint.finish(5)
+        checkpoint.finish(7)
+
+        # Перезапуск: 6 не обработано и придет снова, 7 уже обработано
+        restored = UpdateCheckpoint(self.path)
+        self.assertEqual(restored.offset, 5)
+        self.assertEqual(restored.done, {7})
+        self.assertEqual(restored.in_flight, set())
+
+    def test_known_updates_are_skipped(self):
+        checkpoint = UpdateCheckpoint(self.path)
+        for update_id in (1, 2, 3):
+            checkpoint.begin(update_id)
+        checkpoint.finish(1)
+        checkpoint.finish(3)
+        restored = UpdateCheckpoint(self.path)
+        self.assertTrue(restored.is_known(1))
+        self.assertFalse(restored.is_known(2))
+        self.assertTrue(restored.is_known(3))
+        self.assertFalse(restored.is_known(4))
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = []
+
+    def get_updates(self, **kwargs):
+        self.calls.append(kwargs)
+        return []
+
+
+class UpdatePollerTest(unittest.TestCase):
+    def test_short_long_poll_while_busy(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = UpdateCheckpoint(os.path.join(directory, "update_offset.json"))
+            bot = FakeBot()
+            poller = UpdatePoller(bot, checkpoint, workers=1, long_polling_timeout=20)
+            poller.poll_once()
+            checkpoint.begin(1)
+            poller.poll_once()
+            poller.executor.shutdown()
+        self.assertEqual([call["long_polling_timeout"] for call in bot.calls], [20, 1])
+        self.assertNotIn("timeout", bot.calls[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Optional, Set
+
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+
+# Сохраненная на диск позиция в очереди обновлений Telegram:
+# offset - все обновления с ID <= offset обработаны,
+# done - обработанные обновления выше offset (обработка идет параллельно)
+class UpdateCheckpoint:
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.done: Set[int] = set()
+        self.in_flight: Set[int] = set()
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+            self.offset = int(state.get("offset", 0))
+            self.done = {int(update_id) for update_id in state.get("done", [])}
+            print(f"📌 Продолжаем с обновления {self.offset + 1}")
+        except FileNotFoundError:
+            pass
+        except (ValueError, OSError) as e:
+            print(f"⚠️ Не удалось прочитать {self.path}: {e}")
+
+    def is_known(self, update_id: int) -> bool:
+        with self.lock:
+            return update_id <= self.offset or update_id in self.done or update_id in self.in_flight
+
+    def begin(self, update_id: int):
+        with self.lock:
+            self.in_flight.add(update_id)
+
+    def finish(self, update_id: int):
+        with self.lock:
+            self.in_flight.discard(update_id)
+            self.done.add(update_id)
+            # offset двигается только до первого еще не обработанного обновления
+            if self.in_flight:
+                offset = max(self.offset, min(self.in_flight) - 1)
+            else:
+                offset = max(self.done | {self.offset})
+            self.offset = offset
+            self.done = {update_id for update_id in self.done if update_id > offset}
+            self._save()
+
+    def _save(self):
+        # Атомарная запись: временный файл + fsync + rename
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"offset": self.offset, "done": sorted(self.done)}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️ Не удалось сохранить позицию обновлений: {e}")
+
+
+def update_chat_id(update) -> Optional[int]:
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, field, None)
+        if message is not None:
+            return message.chat.id
+    for field in ("callback_query", "inline_query", "chosen_inline_result"):
+        query = getattr(update, field, None)
+        if query is not None:
+            return query.from_user.id
+    return None
+
+
+# Получает обновления пачками и обрабатывает их в пуле потоков.
+# Telegram подтверждается только offset'ом из checkpoint, поэтому после падения
+# необработанные обновления приходят снова, а уже обработанные пропускаются по ID.
+# Обновления одного чата выполняются строго по очереди: бот - машина состояний по чату
+class UpdatePoller:
+    def __init__(self, bot: telebot.TeleBot, checkpoint: UpdateCheckpoint, workers: int = 4,
+                 batch_size: int = 100, long_polling_timeout: int = 20,
+                 retry_delay: float = 0.25, max_retry_delay: float = 60.0):
+        self.bot = bot
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.long_polling_timeout = long_polling_timeout
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="handler")
+        # Не берем новую пачку, пока предыдущая не разобрана хотя бы частично
+        self.slots = threading.Semaphore(batch_size)
+        self.progress = threading.Event()
+        # chat_id -> обновления, ждущие завершения предыдущего обновления этого чата
+        self.lanes: Dict[int, Deque] = {}
+        self.lanes_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    # Ошибки get_updates (сеть, 429, 5xx) не останавливают бота: повтор с растущей задержкой
+    def run(self):
+        delay = self.retry_delay
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.poll_once()
+                    delay = self.retry_delay
+                    continue
+                except ApiTelegramException as e:
+                    wait = delay
+                    if e.error_code == 429:
+                        wait = (e.result_json or {}).get('parameters', {}).get('retry_after', delay)
+                    print(f"⚠️ Ошибка Telegram API при получении обновлений: {e}")
+                except Exception as e:
+                    wait = delay
+                    print(f"⚠️ Ошибка получения обновлений: {e}")
+                print(f"⏳ Повтор через {wait:g} сек")
+                self._stop.wait(wait)
+                delay = min(delay * 2, self.max_retry_delay)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def poll_once(self):
+        with self.checkpoint.lock:
+            busy = bool(self.checkpoint.in_flight)
+        self.progress.clear()
+        # Пока есть необработанные обновления, не висим в long polling:
+        # Telegram сразу вернет их же, а новые мы заберем при следующем запросе.
+        # timeout в get_updates - таймаут чтения HTTP, ожидание на стороне Telegram - long_polling_timeout;
+        # 0 telebot заменяет на значение по умолчанию, поэтому минимум - 1 секунда
+        updates = self.bot.get_updates(
+            offset=self.checkpoint.offset + 1,
+            limit=self.batch_size,
+            long_polling_timeout=1 if busy else self.long_polling_timeout
+        )
+        new_updates = [u for u in updates if not self.checkpoint.is_known(u.update_id)]
+        for update in new_updates:
+            self.slots.acquire()
+            self.checkpoint.begin(update.update_id)
+            self._dispatch(update)
+        if busy and not new_updates:
+            # Все полученное уже в работе - ждем, пока что-то завершится
+            self.progress.wait(1.0)
+
+    def _dispatch(self, update):
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            self.executor.submit(self._process, update)
+            return
+        with self.lanes_lock:
+            lane = self.lanes.get(chat_id)
+            if lane is not None:
+                # Чат уже обрабатывается - его поток возьмет обновление следом
+                lane.append(update)
+                return
+            self.lanes[chat_id] = deque()
+        self.executor.submit(self._drain, chat_id, update)
+
+    def _drain(self, chat_id: int, update):
+        while True:
+            self._process(update)
+            with self.lanes_lock:
+                lane = self.lanes[chat_id]
+                if not lane:
+                    del self.lanes[chat_id]
+                    return
+                update = lane.popleft()
+
+    def _process(self, update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            print(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            self.checkpoint.finish(update.update_id)
+            self.slots.release()
+            self.progress.set()
+
+    def stop(self):
+        self._stop.set()
+        self.executor.shutdown(wait=True)